@@ -5,3 +5,9 @@ API_HASH = os.getenv("API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 MONGO_URI = os.getenv("MONGO_URI", "")
 LOG_CHANNEL = int(os.getenv("LOG_CHANNEL", 0))
+# Parallel Telegram file transfers per client (Pyrogram serializes them by default)
+MAX_CONCURRENT_TRANSMISSIONS = int(os.getenv("MAX_CONCURRENT_TRANSMISSIONS", 4))
+# FFmpeg jobs allowed to run at once (more wait their turn); running jobs split the CPUs
+MAX_CONCURRENT_JOBS = max(1, int(os.getenv("MAX_CONCURRENT_JOBS", 4)))
+# Directory for spooling large outputs; empty picks /dev/shm when it has room, else the system temp dir
+TEMP_DIR = os.getenv("TEMP_DIR", "")
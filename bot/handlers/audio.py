@@ -1,9 +1,14 @@
+import asyncio
+import re
 import tempfile
 import os
+from dataclasses import dataclass
+from typing import Optional
 from pyrogram import filters
 from pyrogram.types import Message
 from ..utils.ffmpeg_utils import (
     extract_audio_stream,
+    add_audio_to_video_stream,
     get_supported_audio_formats,
     validate_audio_format,
     estimate_output_size
@@ -14,9 +19,28 @@ from ..utils.progress_tracker import (
     show_error,
     show_success
 )
+from ..utils.ttl_cache import TTLCache
 
-# Store user states for multi-step operations
-user_audio_states = {}
+
+@dataclass(slots=True)
+class AudioState:
+    """Multi-step audio operation state for a single user"""
+    operation: str
+    stage: str
+    format: Optional[str] = None
+    video_message: Optional[Message] = None
+
+
+# Single precompiled match per message for the format/operation command families
+EXTRACT_FORMAT_FILTER = filters.regex(r'^/extract(MP3|OGG|WAV|AAC)\b', re.IGNORECASE)
+ADD_AUDIO_FILTER = filters.regex(r'^/(add|replace)audio\b', re.IGNORECASE)
+
+# Caption for extracted audio uploads
+_EXTRACT_CAPTION = "✅ Audio extracted as {fmt}\n📊 Original video: {mb:.1f} MB\n🎵 Format: {fmt}"
+_INV_MB = 1.0 / (1024 * 1024)
+
+# Store user states for multi-step operations (abandoned flows expire after 30 minutes)
+user_audio_states = TTLCache(maxsize=10_000, ttl=1800)
 
 def register(app):
     """Register audio handlers"""
@@ -50,7 +74,8 @@ def register(app):
             format_info = {
                 'mp3': 'MP3 - Most compatible',
                 'ogg': 'OGG - Open source',
-                'wav': 'WAV - Highest quality'
+                'wav': 'WAV - Highest quality',
+                'aac': 'AAC - Fastest to encode'
             }
             format_text += f"{i}. /extract{fmt.upper()} - {format_info[fmt]}\n"
 
@@ -58,14 +83,13 @@ def register(app):
 
         await message.reply_text(format_text)
 
-    @app.on_message(filters.command(["extractMP3", "extractOGG", "extractWAV"]) & filters.private)
+    @app.on_message(EXTRACT_FORMAT_FILTER & filters.private)
     async def extract_audio_format_command(client, message: Message):
         """Handle specific audio format extraction commands"""
         user_id = message.from_user.id
-        command = message.command[0]
 
         # Extract format from command
-        format_name = command.lower().replace("extract", "")
+        format_name = message.matches[0].group(1).lower()
         if not validate_audio_format(format_name):
             await show_error(
                 client,
@@ -76,16 +100,17 @@ def register(app):
             return
 
         # Store user's extraction preference
-        user_audio_states[user_id] = {
-            'operation': 'extract',
-            'format': format_name,
-            'stage': 'waiting_for_video'
-        }
+        user_audio_states[user_id] = AudioState(
+            operation='extract',
+            format=format_name,
+            stage='waiting_for_video'
+        )
 
         format_names = {
             'mp3': 'MP3',
             'ogg': 'OGG',
-            'wav': 'WAV'
+            'wav': 'WAV',
+            'aac': 'AAC'
         }
 
         text = f"🎯 Selected format: {format_names[format_name]}\n\n"
@@ -94,17 +119,17 @@ def register(app):
 
         await message.reply_text(text)
 
-    @app.on_message(filters.command(["addaudio", "replaceaudio"]) & filters.private)
+    @app.on_message(ADD_AUDIO_FILTER & filters.private)
     async def add_audio_command(client, message: Message):
         """Start audio addition process"""
         user_id = message.from_user.id
-        operation = 'replace' if 'replace' in message.text else 'add'
+        operation = message.matches[0].group(1).lower()
 
         # Store user's audio operation preference
-        user_audio_states[user_id] = {
-            'operation': operation,
-            'stage': 'waiting_for_video'
-        }
+        user_audio_states[user_id] = AudioState(
+            operation=operation,
+            stage='waiting_for_video'
+        )
 
         if operation == 'replace':
             text = "🔄 **Audio Replacement Mode**\n\n"
@@ -123,23 +148,22 @@ def register(app):
         user_id = message.from_user.id
 
         # Check if user is in audio operation process
-        if user_id not in user_audio_states:
+        state = user_audio_states.get(user_id)
+        if state is None:
             return  # Not part of audio operation
 
-        state = user_audio_states[user_id]
-
         # Handle extraction operations
-        if state['operation'] == 'extract' and state['stage'] == 'waiting_for_video':
+        if state.operation == 'extract' and state.stage == 'waiting_for_video':
             await handle_audio_extraction(client, message, state)
             return
 
         # Handle addition/replacement operations - waiting for video
-        if state['operation'] in ['add', 'replace'] and state['stage'] == 'waiting_for_video':
+        if state.operation in ['add', 'replace'] and state.stage == 'waiting_for_video':
             # Store video info and wait for audio file
-            state['stage'] = 'waiting_for_audio'
-            state['video_message'] = message
+            state.stage = 'waiting_for_audio'
+            state.video_message = message
 
-            operation_text = "replace" if state['operation'] == 'replace' else "add"
+            operation_text = "replace" if state.operation == 'replace' else "add"
             text = f"✅ Video received!\n\n"
             text += f"🎵 Now send me the audio file you want to {operation_text} to the video.\n\n"
             text += "💡 Supported formats: MP3, OGG, WAV"
@@ -153,19 +177,18 @@ def register(app):
         user_id = message.from_user.id
 
         # Check if user is in audio operation process
-        if user_id not in user_audio_states:
+        state = user_audio_states.get(user_id)
+        if state is None:
             return  # Not part of audio operation
 
-        state = user_audio_states[user_id]
-
         # Only handle if we're waiting for audio file
-        if state['operation'] in ['add', 'replace'] and state['stage'] == 'waiting_for_audio':
+        if state.operation in ['add', 'replace'] and state.stage == 'waiting_for_audio':
             await handle_audio_addition(client, message, state)
 
     async def handle_audio_extraction(client, message: Message, state):
         """Handle audio extraction from video"""
         user_id = message.from_user.id
-        format_name = state['format']
+        format_name = state.format
 
         try:
             # Create progress tracker
@@ -175,20 +198,24 @@ def register(app):
             file_size = message.video.file_size
             estimated_size = estimate_output_size(file_size, 'extract_audio')
 
-            # Start tracking
-            await tracker.start_processing(estimated_size)
+            async def start_tracking():
+                await tracker.start_processing(estimated_size)
+                await tracker.set_phase(f"Extracting {format_name.upper()} audio")
 
-            # Process video with streaming
-            await tracker.set_phase(f"Extracting {format_name.upper()} audio")
+            # Set up the progress message while the probe and FFmpeg start
+            tracking_task = asyncio.create_task(start_tracking())
 
-            result = await extract_audio_stream(
-                client=client,
-                message=message,
-                format=format_name,
-                caption=f"✅ Audio extracted as {format_name.upper()}\n"
-                       f"📊 Original video: {file_size / (1024*1024):.1f} MB\n"
-                       f"🎵 Format: {format_name.upper()}"
-            )
+            # Process video with streaming
+            try:
+                result = await extract_audio_stream(
+                    client=client,
+                    message=message,
+                    format=format_name,
+                    progress_callback=tracker.update_progress,
+                    caption=_EXTRACT_CAPTION.format_map({'fmt': format_name.upper(), 'mb': file_size * _INV_MB})
+                )
+            finally:
+                await tracking_task
 
             # Mark as complete
             await tracker.complete(success=True)
@@ -212,23 +239,36 @@ def register(app):
     async def handle_audio_addition(client, message: Message, state):
         """Handle audio addition to video"""
         user_id = message.from_user.id
-        operation = state['operation']
-        video_message = state['video_message']
+        operation = state.operation
+        video_message = state.video_message
 
         try:
             # Create progress tracker
             operation_text = "Replacing" if operation == 'replace' else "Adding"
             tracker = AudioProgressTracker(client, video_message, operation_text.lower(), "audio")
 
-            # For now, we'll implement a simplified version
-            # Full implementation would need to handle multiple input streams
-            await show_error(
-                client,
-                video_message,
-                "Feature in development",
-                "Audio addition/replacement requires additional implementation. This feature is being worked on."
+            # Estimate output size
+            file_size = video_message.video.file_size
+            estimated_size = estimate_output_size(file_size, 'add_audio')
+
+            # Start tracking
+            await tracker.start_processing(estimated_size)
+
+            # Stream video and audio through FFmpeg together
+            await tracker.set_phase(f"{operation_text} audio")
+
+            result = await add_audio_to_video_stream(
+                client=client,
+                message=video_message,
+                audio_message=message,
+                replace_audio=operation == 'replace',
+                caption=f"✅ Audio {'replaced' if operation == 'replace' else 'added'}\n"
+                       f"📊 Original video: {file_size / (1024*1024):.1f} MB"
             )
 
+            # Mark as complete
+            await tracker.complete(success=True)
+
             # Clean up user state
             user_audio_states.pop(user_id, None)
 
@@ -267,6 +307,7 @@ def register(app):
 • `/extractMP3` - Extract as MP3 (most compatible)
 • `/extractOGG` - Extract as OGG (open source)
 • `/extractWAV` - Extract as WAV (highest quality)
+• `/extractAAC` - Extract as AAC (fastest to encode)
 
 **Audio Addition:**
 • `/addaudio` - Mix new audio with existing video audio
@@ -292,7 +333,7 @@ def register(app):
 
 **Supported Formats:**
 • Video: MP4, AVI, MOV, MKV
-• Audio: MP3, OGG, WAV
+• Audio: MP3, OGG, WAV, AAC
 
 **Need help?** Use `/cancelaudio` to stop any operation
         """
@@ -1,3 +1,4 @@
+from typing import Optional
 from pyrogram import filters
 from pyrogram.types import Message
 from ..utils.ffmpeg_utils import (
@@ -12,9 +13,44 @@ from ..utils.progress_tracker import (
     show_error,
     show_success
 )
+from ..utils.ttl_cache import TTLCache
+from ..utils.user_locks import UserLocks
+
+# Store user states for multi-step operations (abandoned flows expire after 30 minutes)
+user_encoding_states = TTLCache(maxsize=10_000, ttl=1800)
+
+# Resolution selected by each encode command
+_COMMAND_RESOLUTIONS = {
+    'encode720': '720p',
+    'encode480': '480p',
+    'encode360': '360p'
+}
+
+# Display names for each resolution
+_RESOLUTION_NAMES = {
+    '720p': '720p (HD)',
+    '480p': '480p (SD)',
+    '360p': '360p (Mobile)'
+}
+
+# Video MIME types accepted for encoding
+_SUPPORTED_MIME_TYPES = frozenset({
+    'video/mp4',
+    'video/x-msvideo',
+    'video/quicktime',
+    'video/x-matroska'
+})
+
+# Per-user locks serializing state changes from concurrent handlers
+_user_lock = UserLocks()
+
+
+async def _clear_state(user_id: int, state: Optional[dict] = None):
+    """Remove a user's encoding state, or only the given one if the user has since started another"""
+    async with _user_lock(user_id):
+        if state is None or user_encoding_states.get(user_id) is state:
+            user_encoding_states.pop(user_id, None)
 
-# Store user states for multi-step operations
-user_encoding_states = {}
 
 def register(app):
     """Register encode handlers"""
@@ -41,10 +77,10 @@ def register(app):
     async def encode_resolution_command(client, message: Message):
         """Handle specific resolution encoding commands"""
         user_id = message.from_user.id
-        command = message.command[0]
+        command = message.command[0].lower()
 
         # Extract resolution from command
-        resolution = command.replace("encode", "")
+        resolution = _COMMAND_RESOLUTIONS.get(command, command.replace("encode", ""))
         if not validate_resolution(resolution):
             await show_error(
                 client,
@@ -54,19 +90,26 @@ def register(app):
             )
             return
 
-        # Store user's encoding preference
-        user_encoding_states[user_id] = {
-            'resolution': resolution,
-            'stage': 'waiting_for_video'
-        }
-
-        resolution_names = {
-            '720p': '720p (HD)',
-            '480p': '480p (SD)',
-            '360p': '360p (Mobile)'
-        }
+        # Store user's encoding preference, unless an encode of theirs is still running
+        async with _user_lock(user_id):
+            state = user_encoding_states.get(user_id)
+            busy = state is not None and state['stage'] == 'processing'
+            if not busy:
+                user_encoding_states[user_id] = {
+                    'resolution': resolution,
+                    'stage': 'waiting_for_video'
+                }
+
+        if busy:
+            await show_error(
+                client,
+                message,
+                "Encoding in progress",
+                "Wait for your current encode to finish before starting another"
+            )
+            return
 
-        text = f"🎯 Selected resolution: {resolution_names[resolution]}\n\n"
+        text = f"🎯 Selected resolution: {_RESOLUTION_NAMES[resolution]}\n\n"
         text += "📹 Now send me the video file you want to encode.\n\n"
         text += "💡 Supported formats: MP4, AVI, MOV, MKV"
 
@@ -78,13 +121,10 @@ def register(app):
         user_id = message.from_user.id
 
         # Check if user is in encoding process
-        if user_id not in user_encoding_states:
+        state = user_encoding_states.get(user_id)
+        if state is None or state['stage'] != 'waiting_for_video':
             return  # Not part of encoding operation
 
-        state = user_encoding_states[user_id]
-        if state['stage'] != 'waiting_for_video':
-            return
-
         resolution = state['resolution']
 
         # Validate video file
@@ -110,14 +150,33 @@ def register(app):
             )
             return
 
+        # Check container type (mime_type may be missing on some clients)
+        mime_type = message.video.mime_type
+        if mime_type and mime_type not in _SUPPORTED_MIME_TYPES:
+            await show_error(
+                client,
+                message,
+                "Unsupported format",
+                "Supported formats: MP4, AVI, MOV, MKV"
+            )
+            return
+
+        # Claim the request so a second video can't start a duplicate encode
+        async with _user_lock(user_id):
+            state = user_encoding_states.get(user_id)
+            if state is None or state['stage'] != 'waiting_for_video':
+                return
+            state['stage'] = 'processing'
+
         # Start processing
+        tracker = None
         try:
-            # Create progress tracker
-            tracker = EncodeProgressTracker(client, message, resolution)
-
             # Estimate output size
             estimated_size = estimate_output_size(file_size, 'encode', resolution)
 
+            # Create progress tracker
+            tracker = EncodeProgressTracker(client, message, resolution)
+
             # Start tracking
             await tracker.start_processing(estimated_size)
 
@@ -131,6 +190,7 @@ def register(app):
                 client=client,
                 message=message,
                 resolution=resolution,
+                progress_callback=progress_callback,
                 caption=f"✅ Video encoded to {resolution}\n"
                        f"📊 Original: {file_size / (1024*1024):.1f} MB\n"
                        f"📹 Resolution: {resolution}"
@@ -139,12 +199,13 @@ def register(app):
             # Mark as complete
             await tracker.complete(success=True)
 
-            # Clean up user state
-            user_encoding_states.pop(user_id, None)
+            # Clean up user state (only this job's, not a flow started meanwhile)
+            await _clear_state(user_id, state)
 
         except Exception as e:
-            # Handle errors
-            await tracker.complete(success=False, error_message=str(e))
+            # Handle errors (only touch the progress message if one was sent)
+            if tracker is not None and tracker.progress_message is not None:
+                await tracker.complete(success=False, error_message=str(e))
             await show_error(
                 client,
                 message,
@@ -152,8 +213,8 @@ def register(app):
                 str(e)
             )
 
-            # Clean up user state
-            user_encoding_states.pop(user_id, None)
+            # Clean up user state (only this job's, not a flow started meanwhile)
+            await _clear_state(user_id, state)
 
     @app.on_message(filters.command("cancel") & filters.private)
     async def cancel_encoding(client, message: Message):
@@ -161,7 +222,7 @@ def register(app):
         user_id = message.from_user.id
 
         if user_id in user_encoding_states:
-            user_encoding_states.pop(user_id, None)
+            await _clear_state(user_id)
             await message.reply_text("❌ Encoding operation cancelled")
         else:
             await message.reply_text("No active encoding operation to cancel")
@@ -26,6 +26,6 @@ def register(app):
             return await message.reply("No videos to merge.")
         await message.reply("⚙️ Merging videos...")
         output_path = f"merged_{user_id}.mp4"
-        merge_videos(videos_to_merge[user_id], output_path)
+        await merge_videos(videos_to_merge[user_id], output_path)
         await message.reply_video(output_path, caption="✅ Merged Video")
         videos_to_merge.pop(user_id)
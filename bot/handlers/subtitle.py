@@ -1,11 +1,15 @@
-import tempfile
+import asyncio
 import os
+from typing import Optional
 from pyrogram import filters
 from pyrogram.types import Message
 from ..utils.ffmpeg_utils import (
-    extract_subtitles_stream,
+    extract_subtitle_tracks,
     embed_subtitles_stream,
-    check_video_has_subtitles,
+    subtitle_roundtrip_stream,
+    probe_video_info,
+    get_subtitle_tracks,
+    normalize_subtitle_encoding,
     get_supported_subtitle_formats,
     validate_subtitle_format,
     estimate_output_size
@@ -17,8 +21,156 @@ from ..utils.progress_tracker import (
     show_success
 )
 
-# Store user states for multi-step operations
-user_subtitle_states = {}
+from ..utils.ttl_cache import TTLCache
+from ..utils.user_locks import UserLocks
+
+# Prompt after /extractsub
+_EXTRACT_PROMPT = (
+    "🎯 **Subtitle Extraction Mode**\n\n"
+    "📹 Send me the video file to extract subtitles from.\n\n"
+    "💡 Supported video formats: MP4, AVI, MOV, MKV\n"
+    "📝 Output format: SRT (SubRip)\n"
+    "ℹ️ The bot will extract all subtitle tracks found in the video"
+)
+
+# Prompt after /addsub
+_ADD_PROMPT = (
+    "🎯 **Subtitle Embedding Mode**\n\n"
+    "📝 First, send me the subtitle file (SRT format).\n\n"
+    "💡 After sending the subtitle file, I'll ask for the video file.\n"
+    "📋 The subtitle file should be in SRT format"
+)
+
+# Prompt after /subtitleroundtrip
+_ROUNDTRIP_PROMPT = (
+    "🎯 **Subtitle Round-Trip Mode**\n\n"
+    "📹 Send me a video with a subtitle track.\n\n"
+    "📝 You'll get the track as SRT plus an MP4 with it embedded\n"
+    "⚡ The video is read only once for both results"
+)
+
+# Prompt once the subtitle file is stored
+_SUBTITLE_RECEIVED_PROMPT = (
+    "✅ Subtitle file received!\n\n"
+    "📹 Now send me the video file to embed the subtitles into.\n\n"
+    "💡 Supported video formats: MP4, AVI, MOV, MKV"
+)
+
+# Reply to a new subtitle command while a run is still processing
+_BUSY_TEXT = "⏳ Your previous subtitle operation is still running. Wait for it to finish, then try again."
+
+# Help shown by /subtitlehelp
+_HELP_TEXT = """
+📝 **Subtitle Operations Help**
+
+**Subtitle Extraction:**
+• `/extractsub` - Extract subtitles from video
+• Output format: SRT (SubRip)
+
+**Subtitle Embedding:**
+• `/addsub` - Add subtitles to video
+• Input format: SRT (SubRip)
+
+**Subtitle Round-Trip:**
+• `/subtitleroundtrip` - Extract a subtitle track and embed it in an MP4
+• Reads the video once for both results
+
+**How to extract subtitles:**
+1. Send `/extractsub`
+2. Upload your video file
+3. Wait for processing to complete
+4. Receive SRT subtitle file
+
+**How to embed subtitles:**
+1. Send `/addsub`
+2. Upload your SRT subtitle file first
+3. Upload the video file
+4. Wait for processing to complete
+5. Receive video with embedded subtitles
+
+**Features:**
+✅ Process videos without downloading
+✅ Support for multiple subtitle tracks
+✅ High-quality subtitle extraction
+✅ Embedded subtitles with proper styling
+✅ Progress tracking during processing
+
+**Supported Formats:**
+• Video: MP4, AVI, MOV, MKV
+• Subtitles: SRT (SubRip)
+
+**Notes:**
+• Extraction only works if video contains subtitle tracks
+• Embedding requires SRT subtitle files
+• Embedded subtitles are compatible with most video players
+
+**Need help?** Use `/cancelsub` to stop any operation
+"""
+
+# Accepted subtitle file extensions, e.g. '.srt'
+_VALID_SUB_EXTS = frozenset(f".{fmt}" for fmt in get_supported_subtitle_formats())
+
+# Subtitle uploads are checked against these before anything is downloaded
+MAX_SUBTITLE_SIZE = 5 * 1024 * 1024  # 5MB, far above any real SRT
+_SUBTITLE_MIME_TYPES = frozenset({
+    'application/x-subrip',
+    'text/plain',
+    'application/octet-stream'
+})
+
+# Store user states for multi-step operations (abandoned flows expire after 30 minutes)
+user_subtitle_states = TTLCache(maxsize=10_000, ttl=1800)
+
+# Per-user locks serializing state changes from concurrent handlers
+_user_lock = UserLocks()
+
+
+async def _clear_state(user_id: int, state: Optional[dict] = None):
+    """Remove a user's subtitle state, or only the given one if the user has since started another"""
+    async with _user_lock(user_id):
+        if state is None or user_subtitle_states.get(user_id) is state:
+            user_subtitle_states.pop(user_id, None)
+
+
+async def _start_flow(user_id: int, operation: str, stage: str) -> bool:
+    """Begin a subtitle flow for a user; False while one of their runs is still processing"""
+    async with _user_lock(user_id):
+        state = user_subtitle_states.get(user_id)
+        if state is not None and state['stage'] == 'processing':
+            return False
+        user_subtitle_states[user_id] = {
+            'operation': operation,
+            'stage': stage
+        }
+        return True
+
+
+async def _in_sub_flow(_, __, message: Message) -> bool:
+    """Filter: the sender has an active subtitle flow (async so Pyrogram doesn't run it in a thread)"""
+    return message.from_user is not None and message.from_user.id in user_subtitle_states
+
+
+# Lets the dispatcher skip subtitle handlers for media from users outside a subtitle flow
+in_subtitle_flow = filters.create(_in_sub_flow)
+
+# Image-based subtitle codecs, which FFmpeg can't convert to SRT
+_BITMAP_SUBTITLE_CODECS = frozenset({'hdmv_pgs_subtitle', 'dvd_subtitle', 'dvb_subtitle', 'xsub'})
+
+
+def _format_mb(size: int) -> str:
+    """Size as 'X.Y MB' using integer shifts (tenths truncated, not rounded)"""
+    return f"{size >> 20}.{((size >> 10) & 1023) * 10 >> 10} MB"
+
+
+def _track_caption(track_index: int, language, size_mb: str) -> str:
+    """Caption for one extracted subtitle track"""
+    label = f"{track_index} ({language})" if language else f"{track_index}"
+    return (
+        f"✅ Subtitle track {label} extracted\n"
+        f"📊 Source video: {size_mb}\n"
+        f"📝 Format: SRT (SubRip)"
+    )
+
 
 def register(app):
     """Register subtitle handlers"""
@@ -28,7 +180,8 @@ def register(app):
         """Show subtitle operation options"""
         options = [
             ("/extractsub", "Extract subtitles from video"),
-            ("/addsub", "Add subtitles to video")
+            ("/addsub", "Add subtitles to video"),
+            ("/subtitleroundtrip", "Extract subtitles and embed them in an MP4, in one pass")
         ]
 
         await show_operation_menu(
@@ -44,18 +197,11 @@ def register(app):
         user_id = message.from_user.id
 
         # Store user's extraction preference
-        user_subtitle_states[user_id] = {
-            'operation': 'extract',
-            'stage': 'waiting_for_video'
-        }
-
-        text = "🎯 **Subtitle Extraction Mode**\n\n"
-        text += "📹 Send me the video file to extract subtitles from.\n\n"
-        text += "💡 Supported video formats: MP4, AVI, MOV, MKV\n"
-        text += "📝 Output format: SRT (SubRip)\n"
-        text += "ℹ️ The bot will extract all subtitle tracks found in the video"
+        if not await _start_flow(user_id, 'extract', 'waiting_for_video'):
+            await message.reply_text(_BUSY_TEXT)
+            return
 
-        await message.reply_text(text)
+        await message.reply_text(_EXTRACT_PROMPT)
 
     @app.on_message(filters.command("addsub") & filters.private)
     async def add_subtitle_command(client, message: Message):
@@ -63,53 +209,66 @@ def register(app):
         user_id = message.from_user.id
 
         # Store user's addition preference
-        user_subtitle_states[user_id] = {
-            'operation': 'add',
-            'stage': 'waiting_for_subtitle'
-        }
+        if not await _start_flow(user_id, 'add', 'waiting_for_subtitle'):
+            await message.reply_text(_BUSY_TEXT)
+            return
 
-        text = "🎯 **Subtitle Embedding Mode**\n\n"
-        text += "📝 First, send me the subtitle file (SRT format).\n\n"
-        text += "💡 After sending the subtitle file, I'll ask for the video file.\n"
-        text += "📋 The subtitle file should be in SRT format"
+        await message.reply_text(_ADD_PROMPT)
 
-        await message.reply_text(text)
+    @app.on_message(filters.command("subtitleroundtrip") & filters.private)
+    async def subtitle_roundtrip_command(client, message: Message):
+        """Start a combined extract + re-embed run"""
+        user_id = message.from_user.id
 
-    @app.on_message(filters.video & filters.private)
+        # Store user's round-trip preference
+        if not await _start_flow(user_id, 'roundtrip', 'waiting_for_video'):
+            await message.reply_text(_BUSY_TEXT)
+            return
+
+        await message.reply_text(_ROUNDTRIP_PROMPT)
+
+    @app.on_message(filters.video & filters.private & in_subtitle_flow)
     async def handle_video_for_subtitle(client, message: Message):
         """Handle video file for subtitle operations"""
         user_id = message.from_user.id
 
-        # Check if user is in subtitle operation process
-        if user_id not in user_subtitle_states:
-            return  # Not part of subtitle operation
-
-        state = user_subtitle_states[user_id]
+        # Claim the request so a second video can't start a duplicate run
+        async with _user_lock(user_id):
+            state = user_subtitle_states.get(user_id)
+            if state is None or state['stage'] != 'waiting_for_video':
+                return  # Not part of subtitle operation
+            state['stage'] = 'processing'
+            user_subtitle_states[user_id] = state  # Refresh the TTL
 
         # Handle extraction operations
-        if state['operation'] == 'extract' and state['stage'] == 'waiting_for_video':
+        if state['operation'] == 'extract':
             await handle_subtitle_extraction(client, message, state)
             return
 
         # Handle addition operations - waiting for video
-        if state['operation'] == 'add' and state['stage'] == 'waiting_for_video':
+        if state['operation'] == 'add':
             await handle_subtitle_embedding(client, message, state)
             return
 
-    @app.on_message(filters.document & filters.private)
+        # Handle combined extract + embed operations
+        if state['operation'] == 'roundtrip':
+            await handle_subtitle_roundtrip(client, message, state)
+            return
+
+    @app.on_message(filters.document & filters.private & in_subtitle_flow)
     async def handle_subtitle_file(client, message: Message):
         """Handle subtitle file for embedding operations"""
         user_id = message.from_user.id
 
-        # Check if user is in subtitle operation process
-        if user_id not in user_subtitle_states:
-            return  # Not part of subtitle operation
-
-        state = user_subtitle_states[user_id]
+        # Held for the (small) download so two documents can't both become the subtitle
+        async with _user_lock(user_id):
+            state = user_subtitle_states.get(user_id)
+            if state is None:
+                return  # Not part of subtitle operation
 
-        # Only handle if we're waiting for subtitle file
-        if state['operation'] == 'add' and state['stage'] == 'waiting_for_subtitle':
-            await handle_subtitle_file_upload(client, message, state)
+            # Only handle if we're waiting for subtitle file
+            if state['operation'] == 'add' and state['stage'] == 'waiting_for_subtitle':
+                await handle_subtitle_file_upload(client, message, state)
 
     async def handle_subtitle_extraction(client, message: Message, state):
         """Handle subtitle extraction from video"""
@@ -119,22 +278,24 @@ def register(app):
             # Create progress tracker
             tracker = SubtitleProgressTracker(client, message, "Extracting")
 
-            # Check if video has subtitles
-            has_subtitles = await check_video_has_subtitles(client, message)
+            # List the subtitle tracks from the first few MB of the video
+            video_info = await probe_video_info(client, message)
+            subtitle_tracks = get_subtitle_tracks(video_info)
 
-            if not has_subtitles:
+            if video_info is not None and not subtitle_tracks:
                 await show_error(
                     client,
                     message,
                     "No subtitles found",
                     "This video doesn't contain any subtitle tracks"
                 )
-                user_subtitle_states.pop(user_id, None)
+                await _clear_state(user_id, state)
                 return
 
             # Estimate output size (subtitles are usually small)
             file_size = message.video.file_size
             estimated_size = estimate_output_size(file_size, 'extract_subtitles')
+            size_mb = _format_mb(file_size)  # Shared by every caption of this run
 
             # Start tracking
             await tracker.start_processing(estimated_size)
@@ -142,19 +303,38 @@ def register(app):
             # Process video with streaming
             await tracker.set_phase("Extracting subtitles")
 
-            result = await extract_subtitles_stream(
-                client=client,
-                message=message,
-                caption=f"✅ Subtitles extracted\n"
-                       f"📊 Source video: {file_size / (1024*1024):.1f} MB\n"
-                       f"📝 Format: SRT (SubRip)"
+            # Probing can fail (e.g. MP4 with the index at the end); try the first track then
+            tracks = subtitle_tracks or [{}]
+            languages = [track.get('tags', {}).get('language') for track in tracks]
+
+            # One FFmpeg pass with an SRT output per track; MKVs only fetch their subtitle clusters
+            text_tracks = [
+                index for index, track in enumerate(tracks)
+                if track.get('codec_name') not in _BITMAP_SUBTITLE_CODECS
+            ]
+            failed_tracks = [index for index in range(len(tracks)) if index not in text_tracks]
+            if not text_tracks:
+                raise RuntimeError("Image-based subtitles can't be converted to SRT")
+            failed_tracks += await extract_subtitle_tracks(
+                client,
+                message,
+                text_tracks,
+                [_track_caption(index, languages[index], size_mb) for index in text_tracks],
+                tracker.update_progress
             )
+            if len(failed_tracks) == len(tracks):
+                raise RuntimeError("No subtitles could be extracted")
+            failed_tracks.sort()
 
             # Mark as complete
             await tracker.complete(success=True)
+            if failed_tracks:
+                await message.reply_text(
+                    f"⚠️ Could not extract subtitle track(s): {', '.join(map(str, failed_tracks))}"
+                )
 
             # Clean up user state
-            user_subtitle_states.pop(user_id, None)
+            await _clear_state(user_id, state)
 
         except Exception as e:
             # Handle errors
@@ -167,7 +347,7 @@ def register(app):
             )
 
             # Clean up user state
-            user_subtitle_states.pop(user_id, None)
+            await _clear_state(user_id, state)
 
     async def handle_subtitle_file_upload(client, message: Message, state):
         """Handle uploaded subtitle file"""
@@ -183,8 +363,8 @@ def register(app):
             )
             return
 
-        file_name = message.document.file_name.lower()
-        if not file_name.endswith('.srt'):
+        file_name = (message.document.file_name or '').lower()
+        if os.path.splitext(file_name)[1] not in _VALID_SUB_EXTS:
             await show_error(
                 client,
                 message,
@@ -193,24 +373,31 @@ def register(app):
             )
             return
 
-        # Download subtitle file temporarily
-        try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(mode='wb', suffix='.srt', delete=False) as temp_file:
-                subtitle_path = temp_file.name
+        # Reject oversized or non-text uploads before any download (mime_type may be missing)
+        mime_type = message.document.mime_type
+        if (message.document.file_size or 0) > MAX_SUBTITLE_SIZE or (mime_type and mime_type not in _SUBTITLE_MIME_TYPES):
+            await show_error(
+                client,
+                message,
+                "Invalid file",
+                f"Subtitle file must be a text SRT file under {MAX_SUBTITLE_SIZE >> 20} MB"
+            )
+            return
 
-                # Download subtitle file
-                await message.download(subtitle_path)
+        # Stream the subtitle file straight into memory (SRTs are only a few KB)
+        try:
+            subtitle_data = bytearray()
+            async for chunk in client.stream_media(message):
+                subtitle_data.extend(chunk)
+                if len(subtitle_data) > MAX_SUBTITLE_SIZE:
+                    raise ValueError(f"Subtitle file is larger than {MAX_SUBTITLE_SIZE >> 20} MB")
 
             # Update state to wait for video
             state['stage'] = 'waiting_for_video'
-            state['subtitle_path'] = subtitle_path
-
-            text = "✅ Subtitle file received!\n\n"
-            text += "📹 Now send me the video file to embed the subtitles into.\n\n"
-            text += "💡 Supported video formats: MP4, AVI, MOV, MKV"
+            state['subtitle_bytes'] = await asyncio.to_thread(normalize_subtitle_encoding, subtitle_data)
+            user_subtitle_states[user_id] = state  # Refresh the TTL
 
-            await message.reply_text(text)
+            await message.reply_text(_SUBTITLE_RECEIVED_PROMPT)
 
         except Exception as e:
             await show_error(
@@ -220,12 +407,12 @@ def register(app):
                 str(e)
             )
             # Clean up user state
-            user_subtitle_states.pop(user_id, None)
+            user_subtitle_states.pop(user_id, None)  # Caller holds the user lock
 
     async def handle_subtitle_embedding(client, message: Message, state):
         """Handle subtitle embedding into video"""
         user_id = message.from_user.id
-        subtitle_path = state['subtitle_path']
+        subtitle_bytes = state['subtitle_bytes']
 
         try:
             # Create progress tracker
@@ -244,23 +431,18 @@ def register(app):
             result = await embed_subtitles_stream(
                 client=client,
                 message=message,
-                subtitle_file_path=subtitle_path,
+                subtitle=subtitle_bytes,
+                progress_callback=tracker.update_progress,
                 caption=f"✅ Subtitles embedded into video\n"
-                       f"📊 Original video: {file_size / (1024*1024):.1f} MB\n"
+                       f"📊 Original video: {_format_mb(file_size)}\n"
                        f"📝 Subtitles: Added successfully"
             )
 
             # Mark as complete
             await tracker.complete(success=True)
 
-            # Clean up temporary subtitle file
-            try:
-                os.unlink(subtitle_path)
-            except:
-                pass
-
             # Clean up user state
-            user_subtitle_states.pop(user_id, None)
+            await _clear_state(user_id, state)
 
         except Exception as e:
             # Handle errors
@@ -272,77 +454,67 @@ def register(app):
                 str(e)
             )
 
-            # Clean up temporary files and state
-            try:
-                if 'subtitle_path' in state:
-                    os.unlink(state['subtitle_path'])
-            except:
-                pass
-            user_subtitle_states.pop(user_id, None)
+            # Clean up user state
+            await _clear_state(user_id, state)
 
-    @app.on_message(filters.command("cancelsub") & filters.private)
-    async def cancel_subtitle_operation(client, message: Message):
-        """Cancel current subtitle operation"""
+    async def handle_subtitle_roundtrip(client, message: Message, state):
+        """Handle subtitle extraction and re-embedding in a single FFmpeg pass"""
         user_id = message.from_user.id
 
-        if user_id in user_subtitle_states:
-            # Clean up temporary files
-            state = user_subtitle_states[user_id]
-            if 'subtitle_path' in state:
-                try:
-                    os.unlink(state['subtitle_path'])
-                except:
-                    pass
+        try:
+            # Create progress tracker
+            tracker = SubtitleProgressTracker(client, message, "Round-tripping")
 
-            user_subtitle_states.pop(user_id, None)
-            await message.reply_text("❌ Subtitle operation cancelled")
-        else:
-            await message.reply_text("No active subtitle operation to cancel")
+            # Estimate output size (subtitles are copied along with the video)
+            file_size = message.video.file_size
+            estimated_size = estimate_output_size(file_size, 'embed_subtitles')
 
-    @app.on_message(filters.command("subtitlehelp") & filters.private)
-    async def subtitle_help_command(client, message: Message):
-        """Show help for subtitle commands"""
-        help_text = """
-📝 **Subtitle Operations Help**
+            # Start tracking
+            await tracker.start_processing(estimated_size)
 
-**Subtitle Extraction:**
-• `/extractsub` - Extract subtitles from video
-• Output format: SRT (SubRip)
+            # Process video with streaming
+            await tracker.set_phase("Extracting and embedding subtitles")
 
-**Subtitle Embedding:**
-• `/addsub` - Add subtitles to video
-• Input format: SRT (SubRip)
+            result = await subtitle_roundtrip_stream(
+                client=client,
+                message=message,
+                progress_callback=tracker.update_progress,
+                caption=f"✅ Subtitles extracted and embedded into video\n"
+                       f"📊 Original video: {_format_mb(file_size)}\n"
+                       f"📝 Subtitles: Sent separately as SRT"
+            )
 
-**How to extract subtitles:**
-1. Send `/extractsub`
-2. Upload your video file
-3. Wait for processing to complete
-4. Receive SRT subtitle file
+            # Mark as complete
+            await tracker.complete(success=True)
 
-**How to embed subtitles:**
-1. Send `/addsub`
-2. Upload your SRT subtitle file first
-3. Upload the video file
-4. Wait for processing to complete
-5. Receive video with embedded subtitles
+            # Clean up user state
+            await _clear_state(user_id, state)
 
-**Features:**
-✅ Process videos without downloading
-✅ Support for multiple subtitle tracks
-✅ High-quality subtitle extraction
-✅ Embedded subtitles with proper styling
-✅ Progress tracking during processing
+        except Exception as e:
+            # Handle errors
+            await tracker.complete(success=False, error_message=str(e))
+            await show_error(
+                client,
+                message,
+                "Subtitle round-trip failed",
+                str(e)
+            )
 
-**Supported Formats:**
-• Video: MP4, AVI, MOV, MKV
-• Subtitles: SRT (SubRip)
+            # Clean up user state
+            await _clear_state(user_id, state)
 
-**Notes:**
-• Extraction only works if video contains subtitle tracks
-• Embedding requires SRT subtitle files
-• Embedded subtitles are compatible with most video players
+    @app.on_message(filters.command("cancelsub") & filters.private)
+    async def cancel_subtitle_operation(client, message: Message):
+        """Cancel current subtitle operation"""
+        user_id = message.from_user.id
 
-**Need help?** Use `/cancelsub` to stop any operation
-        """
+        if user_id in user_subtitle_states:
+            await _clear_state(user_id)
+            await message.reply_text("❌ Subtitle operation cancelled")
+        else:
+            await message.reply_text("No active subtitle operation to cancel")
 
-        await message.reply_text(help_text)
\ No newline at end of file
+    @app.on_message(filters.command("subtitlehelp") & filters.private)
+    async def subtitle_help_command(client, message: Message):
+        """Show help for subtitle commands"""
+        await message.reply_text(_HELP_TEXT, disable_web_page_preview=True)
\ No newline at end of file
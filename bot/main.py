@@ -1,35 +1,32 @@
 # bot/main.py
+import importlib
 import logging
-from pyrogram import Client, filters
-from .config import API_ID, API_HASH, BOT_TOKEN
-from .handlers import (
-    start, merge, trim, compress, rename, screenshot,
-    watermark, encode, subtitle, audio, archive,
-    extract_archive, download_link, url_uploader, metadata
-)
+from pyrogram import Client
+from .config import API_ID, API_HASH, BOT_TOKEN, MAX_CONCURRENT_TRANSMISSIONS
 
 logging.basicConfig(level=logging.INFO)
 
-app = Client("video_editor_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+app = Client(
+    "video_editor_bot",
+    api_id=API_ID,
+    api_hash=API_HASH,
+    bot_token=BOT_TOKEN,
+    max_concurrent_transmissions=MAX_CONCURRENT_TRANSMISSIONS
+)
 
-# Register existing handlers
-start.register(app)
-merge.register(app)
-# Note: trim, compress, rename, screenshot, watermark are imported but handlers don't exist yet
-# compress.register(app)
-# rename.register(app)
-# screenshot.register(app)
-# watermark.register(app)
-archive.register(app)
-extract_archive.register(app)
-download_link.register(app)
-url_uploader.register(app)
-metadata.register(app)
+# Handler modules to load and register, in registration order.
+# Only modules that exist and expose register() are imported.
+HANDLERS = (
+    'start',
+    'merge',
+    # Streaming handlers
+    'encode',
+    'subtitle',
+    'audio',
+)
 
-# Register new streaming handlers
-encode.register(app)
-subtitle.register(app)
-audio.register(app)
+for name in HANDLERS:
+    importlib.import_module(f'.handlers.{name}', __package__).register(app)
 
 if __name__ == "__main__":
     print("📡 Bot is up!")
@@ -2,107 +2,358 @@
 FFmpeg command builders for streaming video processing operations
 """
 
+import subprocess
+from functools import lru_cache
 from typing import List, Optional, Tuple
 
+# Hardware accelerators in order of preference
+HWACCEL_PREFERENCE = ('cuda', 'qsv', 'vaapi', 'videotoolbox')
+
+# On-device scale filter that keeps frames in GPU memory for each accelerator
+# (None when the accelerator has no dedicated scaler and uses software scale)
+HWACCEL_SCALE_FILTERS = {
+    'cuda': 'scale_cuda',
+    'qsv': 'scale_qsv',
+    'vaapi': 'scale_vaapi',
+    'videotoolbox': None,
+}
+
+
+def _ffmpeg_listing(flag: str) -> List[str]:
+    """Run an FFmpeg listing command (e.g. -hwaccels) and return its output lines"""
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', flag],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return []
+
+    return result.stdout.splitlines()
+
+
+# H.264 encoder used with each accelerator, plus the args needed to feed it
+# software frames for a one-frame trial encode
+HWACCEL_ENCODERS = {
+    'cuda': ('h264_nvenc', ()),
+    'qsv': ('h264_qsv', ('-vf', 'format=nv12')),
+    'vaapi': ('h264_vaapi', ('-vaapi_device', '/dev/dri/renderD128', '-vf', 'format=nv12,hwupload')),
+    'videotoolbox': ('h264_videotoolbox', ()),
+}
+
+
+def _encoder_works(hwaccel: str) -> bool:
+    """Check that the accelerator's encoder can actually open a device by encoding one frame"""
+    encoder, trial_args = HWACCEL_ENCODERS[hwaccel]
+    try:
+        result = subprocess.run(
+            [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.04',
+                *trial_args,
+                '-frames:v', '1', '-c:v', encoder,
+                '-f', 'null', '-'
+            ],
+            capture_output=True,
+            timeout=20
+        )
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+    return result.returncode == 0
+
+
+def detect_hwaccel() -> Optional[str]:
+    """
+    Detect the preferred hardware accelerator supported by FFmpeg
+
+    An accelerator only counts if its H.264 encoder is built in and can
+    open a device, and its on-device scale filter is available, so decoded
+    frames never fall back to a software scaler.
 
-def get_resolution_encode_cmd(resolution: str) -> List[str]:
+    Returns:
+        Accelerator name from HWACCEL_PREFERENCE, or None if unavailable
     """
-    Build FFmpeg command for resolution encoding
+    # First line is the "Hardware acceleration methods:" header
+    available = {line.strip() for line in _ffmpeg_listing('-hwaccels')[1:]}
+    if not available:
+        return None
+
+    # Filter and encoder listing lines look like " V....D h264_nvenc   NVIDIA NVENC ..."
+    filters = {fields[1] for fields in map(str.split, _ffmpeg_listing('-filters')) if len(fields) > 1}
+    encoders = {fields[1] for fields in map(str.split, _ffmpeg_listing('-encoders')) if len(fields) > 1}
+
+    for hwaccel in HWACCEL_PREFERENCE:
+        scale_filter = HWACCEL_SCALE_FILTERS[hwaccel]
+        if (
+            hwaccel in available
+            and (scale_filter is None or scale_filter in filters)
+            and HWACCEL_ENCODERS[hwaccel][0] in encoders
+            and _encoder_works(hwaccel)
+        ):
+            return hwaccel
+
+    return None
+
+
+# Detected once at import so every command builder shares the result
+HWACCEL = detect_hwaccel()
+
+
+# Cap how much of a piped input FFmpeg reads before producing output
+# (defaults are 5MB / 5s), for faster time-to-first-byte
+PIPE_INPUT_PROBE_ARGS = ('-probesize', '1000000', '-analyzeduration', '1000000', '-fflags', '+fastseek+genpts')
+
+# MP4 written to a pipe can't seek back to place the moov atom, so emit
+# a fragmented MP4 with the moov up front instead of using faststart
+PIPE_MP4_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# Resolution settings for encoding
+RESOLUTION_SETTINGS = {
+    '720p': {'width': 1280, 'height': 720, 'bitrate': '2000k'},
+    '480p': {'width': 854, 'height': 480, 'bitrate': '1000k'},
+    '360p': {'width': 640, 'height': 360, 'bitrate': '500k'}
+}
+
+
+def _build_resolution_encode_cmd(resolution: str, hwaccel: Optional[str]) -> List[str]:
+    """
+    Build FFmpeg command for resolution encoding from scratch
+
+    Output is tuned for pipe throughput rather than file size: it is
+    streamed straight into the Telegram upload, where upload bandwidth
+    rather than bitrate is the bottleneck.
 
     Args:
         resolution: Target resolution ('720p', '480p', '360p')
+        hwaccel: Hardware accelerator to use (None for software libx264)
 
     Returns:
         FFmpeg command list
     """
-    # Define resolution settings
-    resolution_settings = {
-        '720p': {'width': 1280, 'height': 720, 'bitrate': '2000k'},
-        '480p': {'width': 854, 'height': 480, 'bitrate': '1000k'},
-        '360p': {'width': 640, 'height': 360, 'bitrate': '500k'}
-    }
-
-    if resolution not in resolution_settings:
+    if resolution not in RESOLUTION_SETTINGS:
         raise ValueError(f"Unsupported resolution: {resolution}. Use '720p', '480p', or '360p'")
 
-    settings = resolution_settings[resolution]
+    settings = RESOLUTION_SETTINGS[resolution]
+    width, height, bitrate = settings['width'], settings['height'], settings['bitrate']
+    bufsize = f'{int(bitrate[:-1]) * 2}k'
+
+    # Hardware paths keep decode -> scale -> encode in device memory
+    if hwaccel == 'cuda':
+        input_args = ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-threads', '1']
+        video_args = [
+            '-vf', f'scale_cuda={width}:{height}:format=yuv420p',
+            '-c:v', 'h264_nvenc',
+            '-preset', 'p4',
+            '-rc', 'vbr',
+            '-cq', '23',
+            '-b:v', bitrate,
+        ]
+    elif hwaccel == 'qsv':
+        input_args = ['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv', '-threads', '1']
+        video_args = [
+            '-vf', f'scale_qsv=w={width}:h={height}',
+            '-c:v', 'h264_qsv',
+            '-preset', 'medium',
+            '-global_quality', '23',
+        ]
+    elif hwaccel == 'vaapi':
+        input_args = [
+            '-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi',
+            '-vaapi_device', '/dev/dri/renderD128', '-threads', '1'
+        ]
+        video_args = [
+            '-vf', f'scale_vaapi=w={width}:h={height}:format=nv12',
+            '-c:v', 'h264_vaapi',
+            '-qp', '23',
+        ]
+    elif hwaccel == 'videotoolbox':
+        # No on-device scaler; frames come back to system memory for scale
+        input_args = ['-hwaccel', 'videotoolbox', '-threads', '1']
+        video_args = [
+            '-vf', f'scale={width}:{height}',
+            '-c:v', 'h264_videotoolbox',
+            '-b:v', bitrate,
+        ]
+    else:
+        input_args = []
+        video_args = [
+            '-vf', f'scale={width}:{height}',  # Scale to target resolution
+            '-c:v', 'libx264',  # Video codec
+            '-preset', 'veryfast',  # Favour encoder throughput over file size
+            '-tune', 'zerolatency',  # No lookahead buffering before output
+            '-g', '48',  # Keyframe interval (also sets fragment length)
+            '-keyint_min', '48',
+            '-crf', '23',  # Quality (lower = better quality)
+            '-pix_fmt', 'yuv420p',  # Pixel format for compatibility
+        ]
 
     cmd = [
-        'ffmpeg', '-i', 'pipe:0',  # Read from stdin
-        '-vf', f'scale={settings["width"]}:{settings["height"]}',  # Scale to target resolution
-        '-c:v', 'libx264',  # Video codec
-        '-preset', 'medium',  # Encoding speed vs quality balance
-        '-crf', '23',  # Quality (lower = better quality)
-        '-maxrate', settings['bitrate'],  # Maximum bitrate
-        '-bufsize', f'{int(settings["bitrate"][:-1]) * 2}k',  # Buffer size
-        '-pix_fmt', 'yuv420p',  # Pixel format for compatibility
+        'ffmpeg', *PIPE_INPUT_PROBE_ARGS, *input_args, '-i', 'pipe:0',  # Read from stdin
+        *video_args,
+        '-maxrate', bitrate,  # Maximum bitrate
+        '-bufsize', bufsize,  # Buffer size
         '-c:a', 'aac',  # Audio codec (preserve audio)
         '-b:a', '128k',  # Audio bitrate
         '-ar', '44100',  # Audio sample rate
         '-f', 'mp4',  # Output format
-        '-movflags', 'faststart',  # Optimize for streaming
+        '-movflags', PIPE_MP4_MOVFLAGS,  # Fragmented MP4 for pipe output
         'pipe:1'  # Write to stdout
     ]
 
     return cmd
 
 
-def get_audio_extract_cmd(format: str = 'mp3', bitrate: str = '192k') -> List[str]:
+# Target heights used to keep aspect ratio when scaling
+_TARGET_HEIGHTS = {resolution: settings['height'] for resolution, settings in RESOLUTION_SETTINGS.items()}
+
+# Commands for the detected accelerator, built once at import
+_ENCODE_CMDS = {
+    resolution: tuple(_build_resolution_encode_cmd(resolution, HWACCEL))
+    for resolution in RESOLUTION_SETTINGS
+}
+
+
+def get_resolution_encode_cmd(resolution: str, hwaccel: Optional[str] = HWACCEL) -> List[str]:
+    """
+    Build FFmpeg command for resolution encoding
+
+    Args:
+        resolution: Target resolution ('720p', '480p', '360p')
+        hwaccel: Hardware accelerator to use (None for software libx264)
+
+    Returns:
+        FFmpeg command list
+    """
+    if hwaccel != HWACCEL:
+        return _build_resolution_encode_cmd(resolution, hwaccel)
+
+    try:
+        return list(_ENCODE_CMDS[resolution])
+    except KeyError:
+        raise ValueError(f"Unsupported resolution: {resolution}. Use '720p', '480p', or '360p'") from None
+
+
+# Format-specific audio extraction settings
+AUDIO_FORMAT_SETTINGS = {
+    'mp3': {
+        'codec': 'libmp3lame',
+        'extension': 'mp3',
+        'container': 'mp3',
+        'codec_args': ('-compression_level', '7'),  # LAME quality 7: fast psychoacoustics (0 is slowest)
+        'muxer_args': (),
+    },
+    'ogg': {
+        'codec': 'libvorbis',
+        'extension': 'ogg',
+        'container': 'ogg',
+        'codec_args': (),
+        'muxer_args': (),
+    },
+    'wav': {
+        'codec': 'pcm_s16le',
+        'extension': 'wav',
+        'container': 'wav',
+        'codec_args': (),
+        'muxer_args': ('-rf64', 'auto'),  # Avoid size rewrites on the pipe
+    },
+    'aac': {
+        'codec': 'aac',
+        'extension': 'aac',
+        'container': 'adts',  # Raw AAC stream, no seekable container needed
+        'codec_args': (),
+        'muxer_args': (),
+    },
+}
+
+# Source audio codecs that can be copied into each output container as-is
+AUDIO_STREAM_COPY_CODECS = {
+    'mp3': frozenset({'mp3'}),
+    'ogg': frozenset({'vorbis', 'opus'}),
+    'aac': frozenset({'aac'}),
+}
+
+
+def can_stream_copy_audio(format: str, source_codec: Optional[str]) -> bool:
+    """Check whether the source audio codec fits the target format without re-encoding"""
+    return source_codec in AUDIO_STREAM_COPY_CODECS.get(format, ())
+
+
+def get_audio_extract_cmd(format: str = 'mp3', bitrate: str = '192k', stream_copy: bool = False) -> List[str]:
     """
     Build FFmpeg command for audio extraction
 
     Args:
-        format: Output audio format ('mp3', 'ogg', 'wav')
+        format: Output audio format ('mp3', 'ogg', 'wav', 'aac')
         bitrate: Audio bitrate
+        stream_copy: Copy the source audio stream instead of re-encoding it
 
     Returns:
         FFmpeg command list
     """
-    # Format-specific settings
-    format_settings = {
-        'mp3': {'codec': 'libmp3lame', 'extension': 'mp3'},
-        'ogg': {'codec': 'libvorbis', 'extension': 'ogg'},
-        'wav': {'codec': 'pcm_s16le', 'extension': 'wav'}
-    }
+    if stream_copy:
+        if format not in AUDIO_STREAM_COPY_CODECS:
+            raise ValueError(f"Stream copy is not supported for audio format: {format}")
 
-    if format not in format_settings:
-        raise ValueError(f"Unsupported audio format: {format}. Use 'mp3', 'ogg', or 'wav'")
+        return [
+            'ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0',  # Read from stdin
+            '-vn',  # No video output
+            '-c:a', 'copy',  # Copy audio without re-encoding
+            '-f', AUDIO_FORMAT_SETTINGS[format]['container'],  # Output format
+            'pipe:1'  # Write to stdout
+        ]
 
-    settings = format_settings[format]
+    return list(_build_audio_extract_cmd(format, bitrate))
 
-    cmd = [
-        'ffmpeg', '-i', 'pipe:0',  # Read from stdin
+
+@lru_cache(maxsize=16)
+def _build_audio_extract_cmd(format: str, bitrate: str) -> Tuple[str, ...]:
+    """Build and cache the audio extraction command for a format/bitrate pair"""
+    if format not in AUDIO_FORMAT_SETTINGS:
+        raise ValueError(f"Unsupported audio format: {format}. Use 'mp3', 'ogg', 'wav', or 'aac'")
+
+    settings = AUDIO_FORMAT_SETTINGS[format]
+
+    cmd = (
+        'ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0',  # Read from stdin
         '-vn',  # No video output
         '-c:a', settings['codec'],  # Audio codec
         '-b:a', bitrate,  # Audio bitrate
+        *settings['codec_args'],  # Codec-specific tuning
         '-ar', '44100',  # Sample rate
         '-ac', '2',  # Stereo channels
-        '-f', format,  # Output format
+        '-f', settings['container'],  # Output format
+        *settings['muxer_args'],  # Container-specific options
         'pipe:1'  # Write to stdout
-    ]
+    )
 
     return cmd
 
 
-def get_audio_add_cmd(video_stream: bool = True, replace_audio: bool = False, mix_volume: float = 1.0) -> List[str]:
+def get_audio_add_cmd(
+    video_input: str,
+    audio_input: str,
+    replace_audio: bool = False,
+    mix_volume: float = 1.0
+) -> List[str]:
     """
     Build FFmpeg command for adding audio to video
 
     Args:
-        video_stream: Whether input includes video stream
+        video_input: Video input path or pipe (e.g. a FIFO)
+        audio_input: Audio input path or pipe (e.g. a FIFO)
         replace_audio: Whether to replace existing audio or mix
         mix_volume: Volume level for mixed audio (0.0 to 1.0)
 
     Returns:
-        FFmpeg command list for processing main video first
+        FFmpeg command list
     """
-    # This is a base command - actual implementation will handle audio file separately
     cmd = [
-        'ffmpeg', '-i', 'pipe:0',  # Main video input
-        '-c:v', 'copy',  # Copy video stream without re-encoding
-        '-c:a', 'aac',  # Audio codec
-        '-b:a', '128k',  # Audio bitrate
-        '-ar', '44100',  # Sample rate
+        'ffmpeg',
+        '-i', video_input,  # Main video input
+        '-i', audio_input,  # New audio input
     ]
 
     if replace_audio:
@@ -111,11 +362,17 @@ def get_audio_add_cmd(video_stream: bool = True, replace_audio: bool = False, mi
         # Mix audio streams
         cmd.extend([
             '-filter_complex',
-            f'[0:a][1:a]amix=inputs=2:weights=1 {mix_volume}:duration=longest'
+            f'[0:a][1:a]amix=inputs=2:weights=1 {mix_volume}:duration=longest[aout]',
+            '-map', '0:v:0', '-map', '[aout]'
         ])
 
     cmd.extend([
+        '-c:v', 'copy',  # Copy video stream without re-encoding
+        '-c:a', 'aac',  # Audio codec
+        '-b:a', '128k',  # Audio bitrate
+        '-ar', '44100',  # Sample rate
         '-f', 'mp4',
+        '-movflags', PIPE_MP4_MOVFLAGS,
         'pipe:1'
     ])
 
@@ -133,7 +390,7 @@ def get_subtitle_extract_cmd(track_index: int = 0) -> List[str]:
         FFmpeg command list
     """
     cmd = [
-        'ffmpeg', '-i', 'pipe:0',  # Read from stdin
+        'ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0',  # Read from stdin
         '-map', f'0:s:{track_index}',  # Extract subtitle track
         '-c:s', 'srt',  # Subtitle format
         '-f', 'srt',  # Output format
@@ -143,57 +400,80 @@ def get_subtitle_extract_cmd(track_index: int = 0) -> List[str]:
     return cmd
 
 
-def get_subtitle_embed_cmd(
-    subtitle_file_path: str,
-    subtitle_style: Optional[str] = None
-) -> List[str]:
+def get_subtitle_extract_tracks_cmd(track_outputs: List[Tuple[int, str]]) -> List[str]:
     """
-    Build FFmpeg command for embedding subtitles into video
+    Build FFmpeg command extracting several subtitle tracks to separate SRT outputs in one pass
 
     Args:
-        subtitle_file_path: Path to subtitle file
-        subtitle_style: Custom subtitle styling (optional)
+        track_outputs: (track index, output) pairs, e.g. (1, 'pipe:3'); the last output is usually 'pipe:1'
 
     Returns:
         FFmpeg command list
     """
-    # Default subtitle style
-    default_style = (
-        "FontSize=20,"
-        "PrimaryColour=&Hffffff,"
-        "SecondaryColour=&Hffffff,"
-        "OutlineColour=&H0,"
-        "BackColour=&H80000000,"
-        "Bold=0,"
-        "Italic=0,"
-        "Underline=0,"
-        "StrikeOut=0,"
-        "Spacing=0,"
-        "Angle=0,"
-        "BorderStyle=1,"
-        "Outline=1,"
-        "Shadow=0,"
-        "Alignment=2,"
-        "MarginL=0,"
-        "MarginR=0,"
-        "MarginV=0"
-    )
+    cmd = ['ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0']  # Read from stdin
+    for track_index, output in track_outputs:
+        cmd += [
+            '-map', f'0:s:{track_index}',  # One output per subtitle track...
+            '-c:s', 'srt',  # ...as SubRip
+            '-f', 'srt',
+            output
+        ]
 
-    style = subtitle_style or default_style
+    return cmd
 
-    cmd = [
-        'ffmpeg', '-i', 'pipe:0',  # Video input
-        '-i', subtitle_file_path,  # Subtitle input
+
+def get_subtitle_roundtrip_cmd(subtitle_output: str, track_index: int = 0) -> List[str]:
+    """
+    Build FFmpeg command extracting a subtitle track and remuxing the video with it in one pass
+
+    Args:
+        subtitle_output: Where the SRT goes (e.g. 'pipe:3'); the MP4 goes to stdout
+        track_index: Which subtitle track to extract and embed
+
+    Returns:
+        FFmpeg command list
+    """
+    return [
+        'ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0',  # Read from stdin
+        '-map', f'0:s:{track_index}',  # First output: the subtitle track...
+        '-c:s', 'srt',  # ...as SubRip
+        '-f', 'srt',
+        subtitle_output,
+        '-map', '0:v', '-map', '0:a?', '-map', f'0:s:{track_index}',  # Second output: video, audio, subtitles
         '-c:v', 'copy',  # Copy video without re-encoding
         '-c:a', 'copy',  # Copy audio without re-encoding
         '-c:s', 'mov_text',  # Subtitle codec for MP4
         '-disposition:s:0', 'default',  # Make subtitles default
-        '-metadata:s:s:0', 'language=eng',  # Set subtitle language
         '-f', 'mp4',  # Output format
+        '-movflags', PIPE_MP4_MOVFLAGS,  # Fragmented MP4 for pipe output
         'pipe:1'  # Write to stdout
     ]
 
-    return cmd
+
+_EMBED_PREFIX = ('ffmpeg', *PIPE_INPUT_PROBE_ARGS, '-i', 'pipe:0', '-i')  # Video from stdin, then the subtitle input
+
+
+def get_subtitle_embed_cmd(subtitle_file_path: str) -> List[str]:
+    """
+    Build FFmpeg command for embedding subtitles into video
+
+    Args:
+        subtitle_file_path: Path to subtitle file
+
+    Returns:
+        FFmpeg command list
+    """
+    return [
+        *_EMBED_PREFIX, subtitle_file_path,  # Video input, subtitle input
+        '-c:v', 'copy',  # Copy video without re-encoding
+        '-c:a', 'copy',  # Copy audio without re-encoding
+        '-c:s', 'mov_text',  # Subtitle codec for MP4
+        '-disposition:s:0', 'default',  # Make subtitles default
+        '-metadata:s:s:0', 'language=eng',  # Set subtitle language
+        '-f', 'mp4',  # Output format
+        '-movflags', PIPE_MP4_MOVFLAGS,  # Fragmented MP4 for pipe output
+        'pipe:1'  # Write to stdout
+    ]
 
 
 def get_video_info_cmd() -> List[str]:
@@ -242,23 +522,10 @@ def calculate_video_dimensions(original_width: int, original_height: int, target
     Returns:
         Tuple of (width, height)
     """
-    target_heights = {
-        '720p': 720,
-        '480p': 480,
-        '360p': 360
-    }
-
-    if target_resolution not in target_heights:
-        raise ValueError(f"Unsupported resolution: {target_resolution}")
-
-    target_height = target_heights[target_resolution]
-    aspect_ratio = original_width / original_height
-    target_width = int(target_height * aspect_ratio)
-
-    # Ensure even dimensions for better compatibility
-    if target_width % 2 != 0:
-        target_width += 1
-    if target_height % 2 != 0:
-        target_height += 1
-
-    return (target_width, target_height)
+    try:
+        target_height = _TARGET_HEIGHTS[target_resolution]
+    except KeyError:
+        raise ValueError(f"Unsupported resolution: {target_resolution}") from None
+
+    # Integer math, rounding both dimensions up to even for better compatibility
+    return ((target_height * original_width // original_height + 1) & ~1, (target_height + 1) & ~1)
@@ -1,70 +1,433 @@
-import subprocess
+import asyncio
+import codecs
+import contextlib
+import errno
+import io
 import os
-from .stream_processor import process_video_stream
+import shutil
+import tempfile
+
+try:
+    import orjson as _json  # Faster decoding, accepts bytes directly
+except ImportError:
+    import json as _json
+
+try:
+    from charset_normalizer import from_bytes as _detect_charset  # Optional, better guesses for legacy encodings
+except ImportError:
+    _detect_charset = None
+
+from pyrogram.errors import RPCError
+from .stream_processor import process_video_stream, video_processor, _enlarge_pipes, TELEGRAM_CHUNK_SIZE
+from .mkv_cues import TelegramRangeReader, locate_subtitle_clusters, iter_subtitle_clusters
 from .ffmpeg_stream import (
     get_resolution_encode_cmd,
     get_audio_extract_cmd,
+    can_stream_copy_audio,
+    AUDIO_STREAM_COPY_CODECS,
+    AUDIO_FORMAT_SETTINGS,
     get_audio_add_cmd,
     get_subtitle_extract_cmd,
+    get_subtitle_extract_tracks_cmd,
     get_subtitle_embed_cmd,
+    get_subtitle_roundtrip_cmd,
+    get_video_info_cmd,
     has_subtitles_cmd,
     calculate_video_dimensions
 )
 
+# Number of 1MB chunks fed to ffprobe when probing stream metadata
+PROBE_CHUNKS = 5
 
-def merge_videos(input_files, output_path):
-    """Original merge function - kept for backward compatibility"""
-    with open("inputs.txt", "w") as f:
+# Seconds between attempts to open a FIFO that FFmpeg hasn't opened for reading yet
+FIFO_OPEN_POLL_INTERVAL = 0.05
+
+# Seconds to wait for cancelled FIFO feeders to finish closing their pipes
+FIFO_FEEDER_STOP_TIMEOUT = 5
+
+
+def _write_concat_list(input_files):
+    """Write an FFmpeg concat demuxer list to a unique temp file and return its path"""
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
         for fpath in input_files:
             f.write(f"file '{fpath}'\n")
-    subprocess.run(
-        ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", "inputs.txt", "-c", "copy", output_path],
-        check=True
-    )
+    return f.name
 
-    # Clean up temporary file
-    if os.path.exists("inputs.txt"):
-        os.remove("inputs.txt")
+
+async def merge_videos(input_files, output_path):
+    """Original merge function - kept for backward compatibility"""
+    # Unique list file per merge so concurrent merges don't clobber each other
+    list_path = await asyncio.to_thread(_write_concat_list, input_files)
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr_output = await process.communicate()
+
+        if process.returncode != 0:
+            error_msg = stderr_output.decode() if stderr_output else "Unknown FFmpeg error"
+            raise RuntimeError(f"FFmpeg merge failed: {error_msg}")
+    finally:
+        # Clean up temporary file
+        if os.path.exists(list_path):
+            os.remove(list_path)
 
 
 # New streaming functions
-async def encode_video_stream(client, message, resolution, caption=None):
+async def encode_video_stream(client, message, resolution, caption=None, progress_callback=None):
     """Encode video to specified resolution using streaming"""
     cmd = get_resolution_encode_cmd(resolution)
     final_caption = caption or f"Video encoded to {resolution}"
-    return await process_video_stream(client, message, cmd, final_caption)
+    return await process_video_stream(client, message, cmd, final_caption, progress_callback)
+
+
+async def probe_video_info(client, message, probe_chunks=PROBE_CHUNKS):
+    """Probe stream metadata with ffprobe using only the first few MB of the video"""
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *get_video_info_cmd(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        _enlarge_pipes(process)
+
+        head = bytearray()
+        async for chunk in client.stream_media(message, limit=probe_chunks):
+            head.extend(chunk)
+
+        stdout, _ = await process.communicate(bytes(head))
+        return _json.loads(stdout) if stdout else None
+    except (RPCError, OSError, ValueError):
+        # Telegram error, ffprobe missing or unusable output: callers treat this as "unknown"
+        return None
+    finally:
+        # Never leave ffprobe blocked on stdin, e.g. when the download failed midway
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+def get_audio_codec(video_info):
+    """Get the codec name of the first audio stream from ffprobe output"""
+    if not video_info:
+        return None
+
+    for stream in video_info.get('streams', []):
+        if stream.get('codec_type') == 'audio':
+            return stream.get('codec_name')
 
+    return None
 
-async def extract_audio_stream(client, message, format='mp3', bitrate='192k', caption=None):
+
+def get_subtitle_tracks(video_info):
+    """Get the subtitle streams from ffprobe output, in 0:s:N order (None when probing failed)"""
+    if not video_info:
+        return None
+
+    return [stream for stream in video_info.get('streams', []) if stream.get('codec_type') == 'subtitle']
+
+
+async def extract_audio_stream(client, message, format='mp3', bitrate='192k', caption=None, progress_callback=None):
     """Extract audio from video using streaming"""
-    cmd = get_audio_extract_cmd(format, bitrate)
+    # Copy the audio stream when the source codec already matches the target format
+    source_codec = None
+    if format in AUDIO_STREAM_COPY_CODECS:
+        source_codec = get_audio_codec(await probe_video_info(client, message))
+
+    stream_copy = can_stream_copy_audio(format, source_codec)
+    cmd = get_audio_extract_cmd(format, bitrate, stream_copy=stream_copy)
     final_caption = caption or f"Audio extracted as {format.upper()}"
-    return await process_video_stream(client, message, cmd, final_caption)
+    # Audio-only output, sent as a file named for its format rather than as a video
+    return await process_video_stream(
+        client, message, cmd, final_caption, progress_callback,
+        file_name=f"audio.{AUDIO_FORMAT_SETTINGS[format]['extension']}", as_document=True
+    )
+
+
+async def _pipe_writer(fd: int) -> asyncio.StreamWriter:
+    """Wrap the write end of a pipe or FIFO in a StreamWriter, so writes wait on drain() instead of a thread"""
+    loop = asyncio.get_running_loop()
+    # The transport owns the pipe from here and closes it
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, open(fd, 'wb', buffering=0)
+    )
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def _open_fifo_writer(fifo_path):
+    """Open a FIFO for writing once FFmpeg has it open for reading, without parking a worker thread"""
+    while True:
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:  # ENXIO: FFmpeg hasn't opened its end yet
+                raise
+            await asyncio.sleep(FIFO_OPEN_POLL_INTERVAL)
 
+    return await _pipe_writer(fd)
 
-async def add_audio_to_video_stream(client, message, audio_file_path, replace_audio=False, caption=None):
-    """Add audio to video using streaming"""
-    # This is a simplified version - full implementation would need to handle audio file input
-    cmd = get_audio_add_cmd(replace_audio=replace_audio)
+
+async def _feed_fifo(client, media_message, fifo_path):
+    """Stream a Telegram media message into a named pipe, writing on the event loop"""
+    writer = await _open_fifo_writer(fifo_path)
+    try:
+        async for chunk in client.stream_media(media_message):
+            writer.write(chunk)
+            await writer.drain()  # Waits while FFmpeg is the bottleneck, holding no thread
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # FFmpeg stopped reading before the end of the stream
+    finally:
+        writer.close()  # Flushes what is still buffered, then closes the pipe
+
+
+async def add_audio_to_video_stream(client, message, audio_message, replace_audio=False, caption=None):
+    """Add audio to video using streaming, feeding both inputs through named pipes"""
     final_caption = caption or f"Audio {'replaced' if replace_audio else 'added'} to video"
 
-    # Note: This would need modification to handle the audio file input properly
-    # For now, this is a placeholder for the streaming approach
-    raise NotImplementedError("Audio addition requires handling multiple input streams")
+    fifo_dir = tempfile.mkdtemp()
+    video_fifo = os.path.join(fifo_dir, 'video')
+    audio_fifo = os.path.join(fifo_dir, 'audio')
+    os.mkfifo(video_fifo)
+    os.mkfifo(audio_fifo)
+
+    cmd = get_audio_add_cmd(video_fifo, audio_fifo, replace_audio=replace_audio)
 
+    feed_tasks = [
+        asyncio.create_task(_feed_fifo(client, message, video_fifo)),
+        asyncio.create_task(_feed_fifo(client, audio_message, audio_fifo))
+    ]
 
-async def extract_subtitles_stream(client, message, track_index=0, caption=None):
+    try:
+        output_stream = video_processor.process_with_ffmpeg(None, cmd)
+        return await video_processor.send_processed_video(client, message, output_stream, final_caption)
+    finally:
+        # FFmpeg is gone; a feeder still waiting for it to open its FIFO, or to read, never will
+        for task in feed_tasks:
+            task.cancel()
+        await asyncio.wait(feed_tasks, timeout=FIFO_FEEDER_STOP_TIMEOUT)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+
+async def extract_subtitles_stream(client, message, track_index=0, caption=None, progress_callback=None):
     """Extract subtitles from video using streaming"""
     cmd = get_subtitle_extract_cmd(track_index)
     final_caption = caption or f"Subtitles extracted from track {track_index}"
-    return await process_video_stream(client, message, cmd, final_caption)
+    return await process_video_stream(
+        client, message, cmd, final_caption, progress_callback,
+        file_name=f'subtitles_{track_index}.srt', as_document=True
+    )
+
 
+async def _read_side_pipe(fd: int) -> bytes:
+    """Read an FFmpeg side output until every writer has closed it, on the event loop"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=TELEGRAM_CHUNK_SIZE)
+    # The transport owns the pipe from here and closes it
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), open(fd, 'rb', buffering=0)
+    )
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+
+async def extract_subtitle_tracks(client, message, track_indexes, captions, progress_callback=None):
+    """
+    Extract subtitle tracks as separate SRT documents, reading the input once
 
-async def embed_subtitles_stream(client, message, subtitle_file_path, caption=None):
-    """Embed subtitles into video using streaming"""
-    cmd = get_subtitle_embed_cmd(subtitle_file_path)
+    MKVs with a Cues index only have their subtitle clusters fetched, located
+    once for all tracks; other files are streamed end to end. Each track is
+    one FFmpeg output: the last goes to stdout, the others to side pipes.
+
+    Returns:
+        Indexes of the tracks that came out empty and were not sent
+    """
+    input_stream = None
+    if message.video.mime_type == 'video/x-matroska':
+        reader = TelegramRangeReader(client, message, message.video.file_size)
+        layout = await locate_subtitle_clusters(reader)
+        if layout is not None:
+            input_stream = iter_subtitle_clusters(reader, *layout)
+    if input_stream is None:
+        input_stream = video_processor.stream_from_telegram(client, message)
+
+    pipes = [os.pipe() for _ in track_indexes[:-1]]
+    side_reads = [asyncio.create_task(_read_side_pipe(read_fd)) for read_fd, _ in pipes]
+    outputs = [f'pipe:{write_fd}' for _, write_fd in pipes] + ['pipe:1']
+    try:
+        cmd = get_subtitle_extract_tracks_cmd(list(zip(track_indexes, outputs)))
+        output_stream = video_processor.process_with_ffmpeg(
+            input_stream, cmd, progress_callback, pass_fds=tuple(write_fd for _, write_fd in pipes)
+        )
+        async with contextlib.aclosing(output_stream):
+            stdout_data = b''.join([chunk async for chunk in output_stream])
+    finally:
+        # FFmpeg's copies are gone by now; closing ours gives the side readers their EOF
+        for _, write_fd in pipes:
+            os.close(write_fd)
+        side_data = await asyncio.gather(*side_reads, return_exceptions=True)
+
+    failed = []
+    for track_index, caption, data in zip(track_indexes, captions, [*side_data, stdout_data]):
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            failed.append(track_index)
+            continue
+        subtitle_file = io.BytesIO(data)
+        subtitle_file.name = f'subtitles_{track_index}.srt'  # Pyrogram needs a name on in-memory uploads
+        await message.reply_document(document=subtitle_file, caption=caption)
+    return failed
+
+
+# Byte order marks, longest first (the UTF-32 LE mark starts with the UTF-16 LE one)
+_SUBTITLE_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')
+)
+
+# Bytes sampled when guessing the encoding of a subtitle file
+SUBTITLE_SNIFF_SIZE = 4096
+
+
+def _guess_bomless_utf(sample: bytes):
+    """
+    Guess the UTF-16/32 flavour of BOM-less text from where its NUL bytes fall
+
+    Text subtitles never contain NUL, but mostly-ASCII UTF-16/32 is full of
+    them in fixed positions (and is still valid UTF-8, NULs included).
+    """
+    quarter = len(sample) // 4
+    if quarter == 0:
+        return None
+    nulls = [sample[offset::4].count(0) / quarter for offset in range(4)]
+
+    def mostly(*offsets):
+        return all(nulls[offset] > 0.5 for offset in offsets)
+
+    if mostly(1, 2, 3):
+        return 'utf-32-le'
+    if mostly(0, 1, 2):
+        return 'utf-32-be'
+    if mostly(1, 3):
+        return 'utf-16-le'
+    if mostly(0, 2):
+        return 'utf-16-be'
+    return None
+
+
+def normalize_subtitle_encoding(data: bytes) -> bytes:
+    """
+    Re-encode subtitle file contents (bytes or bytearray) as UTF-8 without a BOM
+
+    FFmpeg expects UTF-8 subtitles and fails or garbles text on UTF-16 and
+    BOM-prefixed files. CPU-bound, so callers run it in a worker thread.
+    """
+    for bom, encoding in _SUBTITLE_BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding, errors='replace').encode('utf-8')
+
+    if b'\x00' in data[:SUBTITLE_SNIFF_SIZE]:
+        encoding = _guess_bomless_utf(data[:SUBTITLE_SNIFF_SIZE])
+        if encoding is None:
+            raise ValueError("Subtitle file is not text (it contains NUL bytes)")
+        return data.decode(encoding, errors='replace').encode('utf-8')
+
+    try:
+        data.decode('utf-8')
+        return data  # Already UTF-8, the common case
+    except UnicodeDecodeError:
+        pass
+
+    encoding = None
+    if _detect_charset is not None:
+        best = _detect_charset(data[:SUBTITLE_SNIFF_SIZE]).best()
+        encoding = best.encoding if best else None
+
+    try:
+        return data.decode(encoding or 'cp1252', errors='replace').encode('utf-8')
+    except LookupError:
+        return data.decode('cp1252', errors='replace').encode('utf-8')
+
+
+async def _write_side_pipe(fd: int, data: bytes):
+    """Write data to an FFmpeg side input and close it, on the event loop"""
+    writer = await _pipe_writer(fd)
+    try:
+        writer.write(data)
+        await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # FFmpeg exited without reading the whole input
+    finally:
+        writer.close()  # Flushes what is still buffered, then closes the pipe
+
+
+async def embed_subtitles_stream(client, message, subtitle, caption=None, progress_callback=None):
+    """
+    Embed subtitles into video using streaming
+
+    subtitle is the subtitle file contents, handed to FFmpeg through an
+    anonymous pipe so it never touches disk.
+    """
     final_caption = caption or "Subtitles embedded into video"
-    return await process_video_stream(client, message, cmd, final_caption)
+
+    read_fd, write_fd = os.pipe()
+    # Written on the event loop, not in a worker thread the spool writes also need
+    writer = asyncio.create_task(_write_side_pipe(write_fd, subtitle))
+    try:
+        cmd = get_subtitle_embed_cmd(f'pipe:{read_fd}')
+        input_stream = video_processor.stream_from_telegram(client, message)
+        output_stream = video_processor.process_with_ffmpeg(input_stream, cmd, progress_callback, pass_fds=(read_fd,))
+        return await video_processor.send_processed_video(client, message, output_stream, final_caption)
+    finally:
+        # Closing our read end unblocks the writer if FFmpeg never drained the pipe
+        os.close(read_fd)
+        await writer
+
+
+async def subtitle_roundtrip_stream(client, message, track_index=0, caption=None, progress_callback=None):
+    """
+    Extract a subtitle track and send the video remuxed with it embedded, reading the input once
+
+    The MP4 comes out of FFmpeg's stdout; the SRT goes through a second
+    anonymous pipe and is sent as a document after the video.
+    """
+    final_caption = caption or f"Subtitle track {track_index} extracted and embedded into video"
+
+    read_fd, write_fd = os.pipe()
+    # Read on the event loop, not in a worker thread the spool writes also need
+    reader = asyncio.create_task(_read_side_pipe(read_fd))
+    try:
+        cmd = get_subtitle_roundtrip_cmd(f'pipe:{write_fd}', track_index)
+        input_stream = video_processor.stream_from_telegram(client, message)
+        output_stream = video_processor.process_with_ffmpeg(input_stream, cmd, progress_callback, pass_fds=(write_fd,))
+        # Closed here too, so FFmpeg is gone even when sending fails before reading to the end
+        async with contextlib.aclosing(output_stream):
+            result = await video_processor.send_processed_video(client, message, output_stream, final_caption)
+    finally:
+        # FFmpeg's copy is gone by now; closing ours gives the reader its EOF
+        os.close(write_fd)
+        subtitle_data = await reader
+
+    # The video is already delivered; an empty track must not turn that into a failure
+    if not subtitle_data:
+        await message.reply_text(f"⚠️ Subtitle track {track_index} has no text to send as SRT")
+        return result
+
+    subtitle_file = io.BytesIO(subtitle_data)
+    subtitle_file.name = f'subtitles_{track_index}.srt'  # Pyrogram needs a name on in-memory uploads
+    await message.reply_document(document=subtitle_file, caption=f"📝 Subtitle track {track_index} (SRT)")
+    return result
 
 
 async def check_video_has_subtitles(client, message):
@@ -79,34 +442,46 @@ async def check_video_has_subtitles(client, message):
         return False
 
 
+# Supported formats, in display order
+SUPPORTED_RESOLUTIONS = ('720p', '480p', '360p')
+SUPPORTED_AUDIO_FORMATS = ('mp3', 'ogg', 'wav', 'aac')
+SUPPORTED_SUBTITLE_FORMATS = ('srt',)
+
+_RESOLUTIONS = frozenset(SUPPORTED_RESOLUTIONS)
+_AUDIO_FORMATS = frozenset(SUPPORTED_AUDIO_FORMATS)
+_SUBTITLE_FORMATS = frozenset(SUPPORTED_SUBTITLE_FORMATS)
+
+
 def get_supported_resolutions():
-    """Get list of supported video resolutions"""
-    return ['720p', '480p', '360p']
+    """Get supported video resolutions"""
+    return SUPPORTED_RESOLUTIONS
 
 
 def get_supported_audio_formats():
-    """Get list of supported audio formats"""
-    return ['mp3', 'ogg', 'wav']
+    """Get supported audio formats"""
+    return SUPPORTED_AUDIO_FORMATS
 
 
 def get_supported_subtitle_formats():
-    """Get list of supported subtitle formats"""
-    return ['srt']
-
-
-def validate_resolution(resolution):
-    """Validate if resolution is supported"""
-    return resolution in get_supported_resolutions()
+    """Get supported subtitle formats"""
+    return SUPPORTED_SUBTITLE_FORMATS
 
 
-def validate_audio_format(format):
-    """Validate if audio format is supported"""
-    return format in get_supported_audio_formats()
+# Validate if a resolution / audio format / subtitle format is supported
+validate_resolution = _RESOLUTIONS.__contains__
+validate_audio_format = _AUDIO_FORMATS.__contains__
+validate_subtitle_format = _SUBTITLE_FORMATS.__contains__
 
 
-def validate_subtitle_format(format):
-    """Validate if subtitle format is supported"""
-    return format in get_supported_subtitle_formats()
+# Output/input size ratios keyed by (operation, resolution)
+_SIZE_MULTIPLIERS = {
+    ('encode', '720p'): 0.6,  # Approx 60% of original
+    ('encode', '480p'): 0.4,  # Approx 40% of original
+    ('encode', '360p'): 0.25,  # Approx 25% of original
+    ('extract_audio', None): 0.1,  # Audio is typically ~10% of video size
+    ('add_audio', None): 1.1,  # Slight increase in size
+    ('embed_subtitles', None): 1.1,
+}
 
 
 def estimate_output_size(input_size, operation, resolution=None):
@@ -121,16 +496,5 @@ def estimate_output_size(input_size, operation, resolution=None):
     Returns:
         Estimated output size in bytes
     """
-    if operation == 'encode':
-        if resolution == '720p':
-            return input_size * 0.6  # Approx 60% of original
-        elif resolution == '480p':
-            return input_size * 0.4  # Approx 40% of original
-        elif resolution == '360p':
-            return input_size * 0.25  # Approx 25% of original
-    elif operation == 'extract_audio':
-        return input_size * 0.1  # Audio is typically ~10% of video size
-    elif operation in ['add_audio', 'embed_subtitles']:
-        return input_size * 1.1  # Slight increase in size
-
-    return input_size  # Default estimation
+    key = (operation, resolution if operation == 'encode' else None)
+    return int(input_size * _SIZE_MULTIPLIERS.get(key, 1.0))  # Default estimation: same size
@@ -0,0 +1,264 @@
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+from pyrogram import Client
+from pyrogram.types import Message
+from .stream_processor import TELEGRAM_CHUNK_SIZE
+
+# Matroska element IDs (marker bits included, as they appear in the file)
+EBML_HEADER_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEK_HEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+TRACKS_ID = 0x1654AE6B
+TRACK_ENTRY_ID = 0xAE
+TRACK_NUMBER_ID = 0xD7
+TRACK_TYPE_ID = 0x83
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_TRACK_ID = 0xF7
+CUE_CLUSTER_POSITION_ID = 0xF1
+CLUSTER_ID = 0x1F43B675
+
+TRACK_TYPE_SUBTITLE = 0x11
+MAX_ELEMENT_HEADER = 12  # 4-byte ID + 8-byte size
+
+
+def _vint_length(first_byte: int) -> int:
+    """Length of an EBML variable-size integer from its first byte"""
+    if first_byte == 0:
+        raise ValueError("Invalid EBML variable-size integer")
+    return 9 - first_byte.bit_length()
+
+
+def read_element(buf: bytes, pos: int) -> Tuple[int, int, Optional[int]]:
+    """
+    Read an element header
+
+    Returns:
+        (element ID, offset of the element data, data size or None when unknown)
+    """
+    id_length = _vint_length(buf[pos])
+    element_id = int.from_bytes(buf[pos:pos + id_length], 'big')
+    pos += id_length
+
+    size_length = _vint_length(buf[pos])
+    if pos + size_length > len(buf):
+        raise IndexError("Truncated EBML element header")
+    size = int.from_bytes(buf[pos:pos + size_length], 'big') & ((1 << (7 * size_length)) - 1)
+    if size == (1 << (7 * size_length)) - 1:
+        size = None  # All ones: unknown size (live streams)
+    return element_id, pos + size_length, size
+
+
+def iter_children(buf: bytes, start: int, end: int):
+    """Yield (element ID, data offset, data size) for each child element in buf[start:end]"""
+    pos = start
+    while pos < end:
+        element_id, data_start, size = read_element(buf, pos)
+        if size is None:
+            raise ValueError("Unknown-size element inside a master element")
+        yield element_id, data_start, size
+        pos = data_start + size
+
+
+def _read_uint(buf: bytes, start: int, size: int) -> int:
+    return int.from_bytes(buf[start:start + size], 'big')
+
+
+def _parse_seek_head(buf: bytes, start: int, end: int) -> Dict[int, int]:
+    """Map top-level element IDs to their positions relative to the segment data"""
+    positions = {}
+    for element_id, data_start, size in iter_children(buf, start, end):
+        if element_id != SEEK_ID:
+            continue
+        seek_id = seek_position = None
+        for child_id, child_start, child_size in iter_children(buf, data_start, data_start + size):
+            if child_id == SEEK_ID_ID:
+                seek_id = _read_uint(buf, child_start, child_size)
+            elif child_id == SEEK_POSITION_ID:
+                seek_position = _read_uint(buf, child_start, child_size)
+        if seek_id is not None and seek_position is not None:
+            positions.setdefault(seek_id, seek_position)
+    return positions
+
+
+def _parse_subtitle_tracks(buf: bytes, start: int, end: int) -> List[int]:
+    """Track numbers of the subtitle tracks, in file order (the order of 0:s:N)"""
+    tracks = []
+    for element_id, data_start, size in iter_children(buf, start, end):
+        if element_id != TRACK_ENTRY_ID:
+            continue
+        number = track_type = None
+        for child_id, child_start, child_size in iter_children(buf, data_start, data_start + size):
+            if child_id == TRACK_NUMBER_ID:
+                number = _read_uint(buf, child_start, child_size)
+            elif child_id == TRACK_TYPE_ID:
+                track_type = _read_uint(buf, child_start, child_size)
+        if number is not None and track_type == TRACK_TYPE_SUBTITLE:
+            tracks.append(number)
+    return tracks
+
+
+def _parse_cue_clusters(buf: bytes, start: int, end: int, tracks: set) -> set:
+    """Cluster positions (relative to the segment data) that hold cues for the given tracks"""
+    clusters = set()
+    for element_id, data_start, size in iter_children(buf, start, end):
+        if element_id != CUE_POINT_ID:
+            continue
+        for child_id, child_start, child_size in iter_children(buf, data_start, data_start + size):
+            if child_id != CUE_TRACK_POSITIONS_ID:
+                continue
+            track = cluster_position = None
+            for pos_id, pos_start, pos_size in iter_children(buf, child_start, child_start + child_size):
+                if pos_id == CUE_TRACK_ID:
+                    track = _read_uint(buf, pos_start, pos_size)
+                elif pos_id == CUE_CLUSTER_POSITION_ID:
+                    cluster_position = _read_uint(buf, pos_start, pos_size)
+            if track in tracks and cluster_position is not None:
+                clusters.add(cluster_position)
+    return clusters
+
+
+class TelegramRangeReader:
+    """Random-access reads over a Telegram file, fetched in whole stream_media chunks"""
+
+    def __init__(self, client: Client, message: Message, file_size: int):
+        self.client = client
+        self.message = message
+        self.file_size = file_size
+        self.total_chunks = -(-file_size // TELEGRAM_CHUNK_SIZE)
+        self._cache_first = 0  # Index of the first chunk in _cache
+        self._cache = b''  # Last fetched run of chunks, reused by overlapping reads
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """Read up to length bytes at offset (fewer at the end of the file)"""
+        length = min(length, self.file_size - offset)
+        if length <= 0:
+            return b''
+
+        first = offset // TELEGRAM_CHUNK_SIZE
+        last = (offset + length - 1) // TELEGRAM_CHUNK_SIZE
+        cache_end = self._cache_first + len(self._cache) // TELEGRAM_CHUNK_SIZE  # Whole chunks only
+
+        data = bytearray()
+        fetch_from = first
+        if self._cache_first <= first < cache_end:
+            # Reuse the cached prefix, e.g. a cluster whose header was just read
+            skip = (first - self._cache_first) * TELEGRAM_CHUNK_SIZE
+            data += self._cache[skip:(cache_end - self._cache_first) * TELEGRAM_CHUNK_SIZE]
+            fetch_from = cache_end
+        if fetch_from <= last:
+            async for chunk in self.client.stream_media(self.message, offset=fetch_from, limit=last - fetch_from + 1):
+                data += chunk
+
+        self._cache_first, self._cache = first, bytes(data)
+        start = offset - first * TELEGRAM_CHUNK_SIZE
+        return self._cache[start:start + length]
+
+
+async def locate_subtitle_clusters(
+    reader: TelegramRangeReader,
+    track_index: Optional[int] = None,
+    max_chunk_ratio: float = 0.5
+) -> Optional[Tuple[bytes, List[int]]]:
+    """
+    Find the clusters holding subtitle blocks using the Cues index
+
+    Args:
+        reader: Range reader over the MKV file
+        track_index: Subtitle track (0:s:N) to locate, or None for all subtitle tracks
+        max_chunk_ratio: Give up when more than this share of the file would be fetched anyway
+
+    Returns:
+        (header bytes up to the first cluster, sorted absolute cluster offsets),
+        or None when the file has no usable Cues and a linear scan is needed
+    """
+    try:
+        head = await reader.read(0, TELEGRAM_CHUNK_SIZE)
+
+        element_id, data_start, size = read_element(head, 0)
+        if element_id != EBML_HEADER_ID or size is None:
+            return None
+        element_id, segment_start, _ = read_element(head, data_start + size)
+        if element_id != SEGMENT_ID:
+            return None
+
+        # Walk the top-level elements that precede the first cluster
+        seek_positions, subtitle_tracks, first_cluster = {}, None, None
+        pos = segment_start
+        while pos + MAX_ELEMENT_HEADER <= len(head):
+            element_id, data_start, size = read_element(head, pos)
+            if element_id == CLUSTER_ID:
+                first_cluster = pos
+                break
+            if size is None or data_start + size > len(head):
+                return None  # e.g. large attachments before the first cluster
+            if element_id == SEEK_HEAD_ID:
+                seek_positions.update(_parse_seek_head(head, data_start, data_start + size))
+            elif element_id == TRACKS_ID:
+                subtitle_tracks = _parse_subtitle_tracks(head, data_start, data_start + size)
+            pos = data_start + size
+
+        if first_cluster is None or not subtitle_tracks or CUES_ID not in seek_positions:
+            return None
+
+        if track_index is None:
+            wanted = set(subtitle_tracks)
+        elif track_index < len(subtitle_tracks):
+            wanted = {subtitle_tracks[track_index]}
+        else:
+            return None
+
+        # Cues usually sit at the end of the file, fetch just that element
+        cues_offset = segment_start + seek_positions[CUES_ID]
+        element_id, data_start, size = read_element(await reader.read(cues_offset, MAX_ELEMENT_HEADER), 0)
+        if element_id != CUES_ID or size is None:
+            return None
+        cues = await reader.read(cues_offset + data_start, size)
+        clusters = sorted(
+            segment_start + position
+            for position in _parse_cue_clusters(cues, 0, len(cues), wanted)
+        )
+        if not clusters:
+            return None
+
+        # Dense subtitles touch most of the file; a single linear pass is cheaper then
+        touched_chunks = {offset // TELEGRAM_CHUNK_SIZE for offset in clusters}
+        if len(touched_chunks) > reader.total_chunks * max_chunk_ratio:
+            return None
+
+        return head[:first_cluster], clusters
+
+    except (IndexError, ValueError):
+        return None  # Malformed or truncated EBML, let FFmpeg deal with it
+
+
+async def iter_subtitle_clusters(
+    reader: TelegramRangeReader,
+    header: bytes,
+    clusters: List[int]
+) -> AsyncGenerator[bytes, None]:
+    """
+    Yield a trimmed MKV stream: the header followed by only the given clusters
+
+    Clusters are self-delimiting and carry absolute timestamps, so FFmpeg reads
+    the result from a pipe like the original file with the other clusters cut out.
+    """
+    yield header
+    for index, offset in enumerate(clusters):
+        element_id, data_start, size = read_element(await reader.read(offset, MAX_ELEMENT_HEADER), 0)
+        if element_id != CLUSTER_ID or size is None:
+            raise RuntimeError(f"Cues point to an invalid cluster at byte {offset}")
+        length = data_start + size
+
+        # When the next cluster starts in the chunk right after this one, fetch up to its
+        # header in the same request so a run of nearby clusters costs one stream_media call
+        span = length
+        if index + 1 < len(clusters):
+            next_offset = clusters[index + 1]
+            if next_offset // TELEGRAM_CHUNK_SIZE <= (offset + length) // TELEGRAM_CHUNK_SIZE + 1:
+                span = max(length, next_offset + MAX_ELEMENT_HEADER - offset)
+
+        yield (await reader.read(offset, span))[:length]
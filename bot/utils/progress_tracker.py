@@ -2,36 +2,39 @@ import asyncio
 import time
 from typing import Optional
 from pyrogram import Client
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
+from .throttle import chat_throttle, progress_dispatcher
 
 
 class ProgressTracker:
     """Handles progress reporting for video processing operations"""
 
-    def __init__(self, client: Client, message: Message, operation_name: str):
+    def __init__(self, client: Client, message: Message, operation_name: str, mininterval: float = 5):
         self.client = client
         self.message = message
         self.operation_name = operation_name
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         self.total_input_bytes = 0
         self.total_output_bytes = 0
         self.last_update_time = 0
-        self.update_interval = 5  # Update every 5 seconds
+        self.update_interval = mininterval  # Minimum seconds between message edits
         self.progress_message = None
         self.estimated_file_size = None
         self.processing_phase = "Initializing"
+        self._last_text = None  # Last text shown in the progress message
+        self._prefix = f"⚙️ {operation_name}\n"  # Static first line of every progress text
 
     async def start_processing(self, estimated_file_size: Optional[int] = None):
         """Initialize progress tracking"""
         self.estimated_file_size = estimated_file_size
         self.processing_phase = "Starting"
 
-        text = f"⚙️ {self.operation_name}\n"
-        text += f"📊 Status: {self.processing_phase}\n"
-        text += f"⏱️ Time elapsed: 0s"
+        text = f"{self._prefix}📊 Status: {self.processing_phase}\n⏱️ Time elapsed: 0s"
 
         self.progress_message = await self.message.reply_text(text)
-        self.last_update_time = time.time()
+        self._last_text = text
+        self.last_update_time = time.monotonic()
 
     async def update_progress(self, input_bytes: Optional[int] = None, output_bytes: Optional[int] = None):
         """Update progress information"""
@@ -40,77 +43,102 @@ class ProgressTracker:
         if output_bytes is not None:
             self.total_output_bytes = output_bytes
 
-        current_time = time.time()
-        time_since_last_update = current_time - self.last_update_time
-
-        # Only update if enough time has passed
-        if time_since_last_update < self.update_interval and not (input_bytes or output_bytes):
+        # Only update if enough time has passed; counters are kept either way
+        current_time = time.monotonic()
+        if current_time - self.last_update_time < self.update_interval:
             return
 
         elapsed_time = int(current_time - self.start_time)
 
-        # Build progress message
-        text = f"⚙️ {self.operation_name}\n"
-        text += f"📊 Status: {self.processing_phase}\n"
-        text += f"⏱️ Time elapsed: {elapsed_time}s\n"
+        # Build progress message, adding only the lines we have data for
+        parts = [
+            self._prefix,
+            f"📊 Status: {self.processing_phase}\n",
+            f"⏱️ Time elapsed: {elapsed_time}s\n"
+        ]
 
-        # Add file size information
+        # Add file size information (whole MB, so small byte changes don't force an edit)
         if self.total_input_bytes > 0:
-            input_mb = self.total_input_bytes / (1024 * 1024)
-            text += f"📥 Input processed: {input_mb:.1f} MB\n"
+            input_mb = self.total_input_bytes >> 20
+            parts.append(f"📥 Input processed: {input_mb} MB\n")
 
         if self.total_output_bytes > 0:
-            output_mb = self.total_output_bytes / (1024 * 1024)
-            text += f"📤 Output generated: {output_mb:.1f} MB\n"
+            output_mb = self.total_output_bytes >> 20
+            parts.append(f"📤 Output generated: {output_mb} MB\n")
 
             # Calculate processing speed
             if elapsed_time > 0:
-                speed_mbps = output_mb / elapsed_time
-                text += f"🚀 Processing speed: {speed_mbps:.1f} MB/s\n"
+                speed_mbps = output_mb // elapsed_time
+                parts.append(f"🚀 Processing speed: {speed_mbps} MB/s\n")
 
         # Add estimated completion if we have file size
         if self.estimated_file_size and self.total_input_bytes > 0:
             progress_percent = min(100, (self.total_input_bytes / self.estimated_file_size) * 100)
-            text += f"📈 Progress: {progress_percent:.1f}%\n"
+            parts.append(f"📈 Progress: {progress_percent:.1f}%\n")
 
             if elapsed_time > 10 and progress_percent > 0:  # Only estimate after some time
                 estimated_total_time = elapsed_time / (progress_percent / 100)
                 estimated_remaining = int(estimated_total_time - elapsed_time)
-                text += f"⏳ Estimated time remaining: {estimated_remaining}s\n"
+                parts.append(f"⏳ Estimated time remaining: {estimated_remaining}s\n")
 
-        # Edit the progress message
-        try:
-            await self.progress_message.edit_text(text)
+        text = "".join(parts)
+
+        # Nothing changed since the last edit, skip the round-trip
+        if text == self._last_text:
             self.last_update_time = current_time
-        except Exception:
-            # Message might have been deleted or edited by user
-            pass
+            return
+
+        # Progress message may not have been sent yet
+        if self.progress_message is None:
+            return
+
+        # Hand the edit to the shared dispatcher, which drops it if a newer one replaces it
+        progress_dispatcher.submit(self.progress_message, text, self._mark_shown)
+        self.last_update_time = current_time
+
+    def _mark_shown(self, text: str):
+        """Record text the dispatcher actually wrote to the progress message"""
+        self._last_text = text
+
+    async def _edit_progress_message(self, text: str):
+        """Edit the progress message, respecting the per-chat rate limit"""
+        async with chat_throttle.acquire(self.message.chat.id, min_interval=1.0):
+            try:
+                await self.progress_message.edit_text(text)
+            except FloodWait as e:
+                # Telegram told us how long to back off; retry once after that
+                await asyncio.sleep(e.value)
+                await self.progress_message.edit_text(text)
 
     async def set_phase(self, phase: str):
         """Update the processing phase"""
+        if phase == self.processing_phase:
+            return
         self.processing_phase = phase
         await self.update_progress()
 
     async def complete(self, success: bool = True, error_message: Optional[str] = None):
         """Mark processing as complete"""
-        elapsed_time = int(time.time() - self.start_time)
+        elapsed_time = int(time.monotonic() - self.start_time)
 
         if success:
-            text = f"✅ {self.operation_name} completed!\n"
-            text += f"⏱️ Total time: {elapsed_time}s\n"
+            parts = [f"✅ {self.operation_name} completed!\n", f"⏱️ Total time: {elapsed_time}s\n"]
 
             if self.total_output_bytes > 0:
                 output_mb = self.total_output_bytes / (1024 * 1024)
-                text += f"📦 Final size: {output_mb:.1f} MB"
+                parts.append(f"📦 Final size: {output_mb:.1f} MB")
         else:
-            text = f"❌ {self.operation_name} failed!\n"
-            text += f"⏱️ Time elapsed: {elapsed_time}s\n"
+            parts = [f"❌ {self.operation_name} failed!\n", f"⏱️ Time elapsed: {elapsed_time}s\n"]
             if error_message:
-                text += f"🔍 Error: {error_message}"
+                parts.append(f"🔍 Error: {error_message}")
+
+        text = "".join(parts)
 
         try:
             if self.progress_message:
-                await self.progress_message.edit_text(text)
+                # A queued progress edit must not overwrite the final status
+                progress_dispatcher.discard(self.progress_message)
+                await self._edit_progress_message(text)
             else:
                 await self.message.reply_text(text)
         except Exception:
@@ -118,15 +146,6 @@ class ProgressTracker:
             await self.message.reply_text(text)
 
 
-def create_progress_callback(tracker: ProgressTracker):
-    """Create a callback function for progress tracking"""
-
-    async def progress_callback(input_bytes: Optional[int] = None, output_bytes: Optional[int] = None):
-        await tracker.update_progress(input_bytes, output_bytes)
-
-    return progress_callback
-
-
 # Operation-specific tracker classes
 class EncodeProgressTracker(ProgressTracker):
     """Progress tracker specifically for video encoding"""
@@ -1,19 +1,160 @@
 import asyncio
+import io
 import os
+import re
 import tempfile
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
 from typing import AsyncGenerator, Optional, Tuple
 import subprocess
 from pyrogram.types import Message
 from pyrogram import Client
+from ..config import MAX_CONCURRENT_JOBS, MAX_CONCURRENT_TRANSMISSIONS, TEMP_DIR
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# F_SETPIPE_SZ is Linux-only
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', None)
+PIPE_BUFFER_SIZE = 1024 * 1024  # 1MB, the default unprivileged pipe-max-size
+
+
+def _enlarge_pipes(process, size: int = PIPE_BUFFER_SIZE):
+    """
+    Grow the stdin/stdout pipe buffers of a subprocess to cut context switches
+
+    Best effort: silently does nothing where F_SETPIPE_SZ isn't supported.
+    """
+    if F_SETPIPE_SZ is None:
+        return
+
+    for stream in (process.stdin, process.stdout):
+        if stream is None:
+            continue
+        try:
+            # StreamWriter exposes its transport; StreamReader only keeps it privately
+            transport = getattr(stream, 'transport', None) or stream._transport
+            pipe = transport.get_extra_info('pipe')
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, size)
+        except (AttributeError, OSError, ValueError):  # ValueError: pipe already closed
+            pass
+
+
+TELEGRAM_CHUNK_SIZE = 1024 * 1024  # Chunk size used by Client.stream_media offset/limit
+
+STDERR_TAIL_LINES = 256  # FFmpeg log lines kept while processing
+STDERR_ERROR_LINES = 20  # Log lines included in error messages
+
+
+async def _drain_stderr(stream, tail: deque):
+    """
+    Continuously read FFmpeg stderr so a full pipe can never stall FFmpeg
+
+    Keeps only the most recent lines in tail. Progress output uses carriage
+    returns, so both \r and \n end a line.
+    """
+    pending = b''
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        lines = re.split(rb'[\r\n]+', pending + chunk)
+        pending = lines.pop()
+        tail.extend(line.decode(errors='replace') for line in lines if line)
+    if pending:
+        tail.append(pending.decode(errors='replace'))
+
+
+SHM_DIR = '/dev/shm'
+
+
+def _spool_dir(required_bytes: int) -> str:
+    """
+    Pick the directory large outputs are spooled to
+
+    An explicit TEMP_DIR wins. Otherwise use /dev/shm (RAM-backed, no disk
+    I/O) when it is writable and has required_bytes free right now; the
+    small default shm of containers falls back to the system temp dir.
+    Called per spill, since other spools fill shm while the bot runs.
+    """
+    if TEMP_DIR:
+        return TEMP_DIR
+
+    try:
+        if os.access(SHM_DIR, os.W_OK):
+            stats = os.statvfs(SHM_DIR)
+            if stats.f_bavail * stats.f_frsize >= required_bytes:
+                return SHM_DIR
+    except (AttributeError, OSError):  # statvfs is not available on Windows
+        pass
+
+    return tempfile.gettempdir()
+
+
+def _open_spool_file(directory: str):
+    """
+    Create the file a large output spills to
+
+    On Linux this is an O_TMPFILE: an anonymous file the kernel frees as soon
+    as it is closed, even if the bot crashes, uploaded via /proc/self/fd.
+    Elsewhere (or on filesystems without O_TMPFILE) a named temp file is used.
+
+    Returns:
+        (file object, path to upload from, whether the path must be unlinked)
+    """
+    o_tmpfile = getattr(os, 'O_TMPFILE', None)
+    if o_tmpfile is not None:
+        try:
+            fd = os.open(directory, o_tmpfile | os.O_RDWR, 0o600)
+            return os.fdopen(fd, 'w+b'), f'/proc/self/fd/{fd}', False
+        except OSError:
+            pass  # Filesystem doesn't support O_TMPFILE
+
+    temp_file = tempfile.NamedTemporaryFile(suffix='.mp4', dir=directory, delete=False)
+    return temp_file, temp_file.name, True
 
 
 class VideoStreamProcessor:
     """Handles streaming video processing without local file downloads"""
 
     def __init__(self):
-        self.chunk_size = 1024 * 1024  # 1MB chunks
+        self.chunk_size = 4 * 1024 * 1024  # 4MB chunks (also the stdout stream buffer limit)
         self.max_file_size = 2 * 1024 * 1024 * 1024  # 2GB
         self.processing_timeout = 300  # 5 minutes
+        self.progress_bytes_step = 8 * 1024 * 1024  # Report progress every 8MB...
+        self.progress_time_step = 0.5  # ...or every 0.5 seconds, whichever comes first
+        self.spool_max_size = 64 * 1024 * 1024  # Outputs up to 64MB are uploaded from memory
+        self.download_connections = 4  # Parallel byte ranges per Telegram download
+        self.download_queue_chunks = 8  # Chunks buffered per range ahead of the consumer
+        self.download_batch_chunks = 4  # Chunks fetched per stream_media call while holding a slot
+        # Chunk fetches in flight across all users, never more than Pyrogram's transmission slots
+        self.download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSMISSIONS)
+        self.job_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)  # FFmpeg processes allowed at once
+        self.active_jobs = 0  # FFmpeg processes currently running
+        self.filter_threads = 2  # Filter graph threads per FFmpeg process
+        self.shm_outstanding = 0  # Bytes running shm spools may still write, on top of shm's used space
+
+    def _with_thread_args(self, ffmpeg_cmd: list) -> list:
+        """
+        Split the CPUs between the running FFmpeg jobs instead of letting each auto-detect
+
+        A lone job gets every CPU; job_semaphore caps how many run at once, so
+        jobs started while others run can only oversubscribe so far.
+        -filter_threads is global and goes first; -threads is a per-output
+        option and goes right before every output (the last argument and any
+        pipe:N not read with -i), overriding any earlier value.
+        """
+        threads = str(max(1, (os.cpu_count() or 1) // max(self.active_jobs, 1)))
+        cmd = [ffmpeg_cmd[0], '-filter_threads', str(self.filter_threads)]
+        last = len(ffmpeg_cmd) - 1
+        for index in range(1, len(ffmpeg_cmd)):
+            arg = ffmpeg_cmd[index]
+            if index == last or (arg.startswith('pipe:') and ffmpeg_cmd[index - 1] != '-i'):
+                cmd += ('-threads', threads)
+            cmd.append(arg)
+        return cmd
 
     async def stream_from_telegram(self, client: Client, message: Message) -> AsyncGenerator[bytes, None]:
         """
@@ -24,80 +165,186 @@ class VideoStreamProcessor:
             if file_size > self.max_file_size:
                 raise ValueError(f"File too large. Maximum size: {self.max_file_size / (1024**3):.1f}GB")
 
-            async for chunk in client.stream_media(message):
+            async for chunk in self._parallel_stream_media(client, message, file_size):
                 yield chunk
 
         except Exception as e:
             raise RuntimeError(f"Failed to stream video from Telegram: {str(e)}")
 
+    async def _parallel_stream_media(
+        self,
+        client: Client,
+        message: Message,
+        file_size: int
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Download disjoint chunk ranges of a file concurrently and yield them in order
+        """
+        total_chunks = -(-file_size // TELEGRAM_CHUNK_SIZE)
+        if self.download_connections <= 1 or total_chunks <= 1:
+            async for chunk in client.stream_media(message):
+                yield chunk
+            return
+
+        per_range = -(-total_chunks // min(self.download_connections, total_chunks))
+        range_count = -(-total_chunks // per_range)
+
+        # Bounded per-range buffers keep memory flat when later ranges run ahead
+        queues = [asyncio.Queue(maxsize=self.download_queue_chunks) for _ in range(range_count)]
+
+        async def fetch_range(index: int):
+            queue = queues[index]
+            start = index * per_range
+            end = min(start + per_range, total_chunks)
+            try:
+                for offset in range(start, end, self.download_batch_chunks):
+                    limit = min(self.download_batch_chunks, end - offset)
+                    # Hold a transmission slot only while fetching, not while waiting on a full queue
+                    async with self.download_semaphore:
+                        async with aclosing(client.stream_media(message, offset=offset, limit=limit)) as chunks:
+                            batch = [chunk async for chunk in chunks]
+                    for chunk in batch:
+                        await queue.put(chunk)
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)  # End of range
+
+        # Ranges ahead of the consumer stall on their full queues and leave the slots to the rest
+        tasks = [asyncio.create_task(fetch_range(index)) for index in range(range_count)]
+        try:
+            for queue in queues:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @asynccontextmanager
+    async def _ffmpeg_process(self, ffmpeg_cmd: list, pass_fds: Tuple[int, ...] = ()):
+        """
+        Run FFmpeg for the duration of the block
+
+        However the block exits, including the consumer abandoning the output
+        stream mid-way, FFmpeg is killed and reaped so no orphan keeps the CPU.
+        """
+        process = None
+        async with self.job_semaphore:
+            self.active_jobs += 1
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *self._with_thread_args(ffmpeg_cmd),
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=self.chunk_size,  # Let a single read drain a whole chunk
+                    pass_fds=pass_fds  # Extra inputs FFmpeg reads as pipe:N
+                )
+                _enlarge_pipes(process)
+                yield process
+            finally:
+                self.active_jobs -= 1
+                if process is not None and process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
     async def process_with_ffmpeg(
         self,
-        input_stream: AsyncGenerator[bytes, None],
+        input_stream: Optional[AsyncGenerator[bytes, None]],
         ffmpeg_cmd: list,
-        progress_callback: Optional[callable] = None
+        progress_callback: Optional[callable] = None,
+        pass_fds: Tuple[int, ...] = ()
     ) -> AsyncGenerator[bytes, None]:
         """
         Process video stream through FFmpeg and yield output chunks
         """
-        process = None
         try:
-            # Start FFmpeg process
-            process = await asyncio.create_subprocess_exec(
-                *ffmpeg_cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            async with self._ffmpeg_process(ffmpeg_cmd, pass_fds) as process:
+                loop = asyncio.get_running_loop()
 
-            # Feed input stream to FFmpeg
-            async def feed_input():
-                total_bytes = 0
-                async for chunk in input_stream:
-                    if process.stdin:
-                        process.stdin.write(chunk)
-                        total_bytes += len(chunk)
-                        if progress_callback:
-                            await progress_callback(total_bytes, None)  # Progress for input
-                if process.stdin:
-                    process.stdin.close()
-
-            # Start feeding input in background
-            feed_task = asyncio.create_task(feed_input())
-
-            # Read output from FFmpeg
-            output_bytes = 0
-            try:
-                while True:
-                    chunk = await process.stdout.read(self.chunk_size)
-                    if not chunk:
-                        break
-                    output_bytes += len(chunk)
-                    yield chunk
-                    if progress_callback:
-                        await progress_callback(None, output_bytes)  # Progress for output
+                # Feed input stream to FFmpeg (None when FFmpeg reads its inputs itself)
+                async def feed_input():
+                    if input_stream is None:
+                        process.stdin.close()
+                        return
+                    total_bytes = 0
+                    last_cb_bytes, last_cb_time = 0, loop.time()
+                    try:
+                        async for chunk in input_stream:
+                            process.stdin.write(chunk)
+                            try:
+                                # Back-pressure: don't pull more from Telegram than FFmpeg consumes
+                                await process.stdin.drain()
+                            except (BrokenPipeError, ConnectionResetError):
+                                break  # FFmpeg stopped reading; its exit status tells why
+                            total_bytes += len(chunk)
+                            if progress_callback:
+                                now = loop.time()
+                                if (total_bytes - last_cb_bytes > self.progress_bytes_step
+                                        or now - last_cb_time > self.progress_time_step):
+                                    last_cb_bytes, last_cb_time = total_bytes, now
+                                    await progress_callback(total_bytes, None)  # Progress for input
+                        if progress_callback and total_bytes != last_cb_bytes:
+                            await progress_callback(total_bytes, None)
+                    finally:
+                        # Stop any in-flight Telegram downloads right away
+                        await input_stream.aclose()
+                        process.stdin.close()
 
-            except Exception as e:
-                raise RuntimeError(f"Failed to read FFmpeg output: {str(e)}")
+                # Drain stderr and feed input in the background for the whole run
+                stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+                stderr_task = asyncio.create_task(_drain_stderr(process.stderr, stderr_tail))
+                feed_task = asyncio.create_task(feed_input())
+
+                try:
+                    # Read output from FFmpeg
+                    output_bytes = 0
+                    last_cb_bytes, last_cb_time = 0, loop.time()
+                    try:
+                        while True:
+                            chunk = await process.stdout.read(self.chunk_size)
+                            if not chunk:
+                                break
+                            output_bytes += len(chunk)
+                            yield chunk
+                            if progress_callback:
+                                now = loop.time()
+                                if (output_bytes - last_cb_bytes > self.progress_bytes_step
+                                        or now - last_cb_time > self.progress_time_step):
+                                    last_cb_bytes, last_cb_time = output_bytes, now
+                                    await progress_callback(None, output_bytes)  # Progress for output
+                        if progress_callback and output_bytes != last_cb_bytes:
+                            await progress_callback(None, output_bytes)
 
-            # Wait for input feeding to complete
-            await feed_task
+                    except Exception as e:
+                        raise RuntimeError(f"Failed to read FFmpeg output: {str(e)}")
 
-            # Wait for process to complete
-            await asyncio.wait_for(process.wait(), timeout=self.processing_timeout)
+                    # Wait for input feeding to complete
+                    await feed_task
 
-            # Check for FFmpeg errors
-            stderr_output = await process.stderr.read()
-            if process.returncode != 0:
-                error_msg = stderr_output.decode() if stderr_output else "Unknown FFmpeg error"
-                raise RuntimeError(f"FFmpeg processing failed: {error_msg}")
+                    # Wait for process to complete
+                    await asyncio.wait_for(process.wait(), timeout=self.processing_timeout)
+
+                    # Check for FFmpeg errors
+                    await stderr_task
+                    if process.returncode != 0:
+                        error_lines = list(stderr_tail)[-STDERR_ERROR_LINES:]
+                        error_msg = "\n".join(error_lines) if error_lines else "Unknown FFmpeg error"
+                        raise RuntimeError(f"FFmpeg processing failed: {error_msg}")
+                finally:
+                    # No-op after a clean run; on early exit nothing outlives the process
+                    for task in (feed_task, stderr_task):
+                        task.cancel()
+                    await asyncio.gather(feed_task, stderr_task, return_exceptions=True)
 
         except asyncio.TimeoutError:
-            if process:
-                process.kill()
             raise RuntimeError(f"Processing timed out after {self.processing_timeout} seconds")
         except Exception as e:
-            if process:
-                process.kill()
             raise RuntimeError(f"Video processing failed: {str(e)}")
 
     async def send_processed_video(
@@ -105,39 +352,83 @@ class VideoStreamProcessor:
         client: Client,
         message: Message,
         output_stream: AsyncGenerator[bytes, None],
-        caption: str = "Processed video"
+        caption: str = "Processed video",
+        file_name: str = 'video.mp4',
+        as_document: bool = False
     ) -> Message:
         """
         Send the processed video back to user
+
+        Outputs up to spool_max_size stay in memory and are uploaded from
+        there; larger ones spill to a temporary file. Non-video outputs
+        (e.g. subtitles) are sent as a document under file_name.
         """
+        buffer = io.BytesIO()
+        temp_file = None
+        named = False
+        reserved = 0  # Part of shm_outstanding this spool still holds
         try:
-            # Create temporary file for output (Pyrogram needs file path for video upload)
-            with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-                temp_path = temp_file.name
-
-                # Write all chunks to temp file
+            # Close the FFmpeg generator (and so kill FFmpeg) as soon as we stop reading, even on errors
+            async with aclosing(output_stream):
                 async for chunk in output_stream:
-                    temp_file.write(chunk)
+                    if temp_file is None and buffer.tell() + len(chunk) > self.spool_max_size:
+                        # Too big to keep in memory, move what we have to disk. Shm must fit a
+                        # maximum-size output besides what the other running spools may still write
+                        spool_dir = _spool_dir(self.max_file_size + self.shm_outstanding)
+                        if spool_dir == SHM_DIR:
+                            reserved = self.max_file_size
+                            self.shm_outstanding += reserved
+                        temp_file, temp_path, named = await asyncio.to_thread(_open_spool_file, spool_dir)
+                        chunk = buffer.getvalue() + chunk
+                        buffer = None
 
-            # Send video file
-            result = await message.reply_video(
-                video=temp_path,
-                caption=caption
-            )
+                    if temp_file is not None:
+                        # Disk writes run in a worker thread so a slow disk can't stall the event loop
+                        await asyncio.to_thread(temp_file.write, chunk)
+                        # Written bytes now show up in statvfs, stop counting them as outstanding
+                        written = min(len(chunk), reserved)
+                        reserved -= written
+                        self.shm_outstanding -= written
+                    else:
+                        buffer.write(chunk)
 
-            # Clean up temporary file
-            os.unlink(temp_path)
+            if temp_file is not None:
+                # Flush only: closing an O_TMPFILE would free it before the upload
+                await asyncio.to_thread(temp_file.flush)
+                media = temp_path
+            else:
+                # Pyrogram needs a name on in-memory uploads
+                buffer.name = file_name
+                buffer.seek(0)
+                media = buffer
+
+            # file_name is explicit since /proc/self/fd paths have no useful basename
+            if as_document:
+                return await message.reply_document(
+                    document=media,
+                    caption=caption,
+                    file_name=file_name
+                )
 
-            return result
+            # Send video file
+            return await message.reply_video(
+                video=media,
+                caption=caption,
+                file_name=file_name
+            )
 
         except Exception as e:
-            # Clean up on error
-            if 'temp_path' in locals():
+            raise RuntimeError(f"Failed to send processed video: {str(e)}")
+        finally:
+            self.shm_outstanding -= reserved
+            # Clean up temporary file
+            if temp_file is not None:
                 try:
-                    os.unlink(temp_path)
-                except:
+                    await asyncio.to_thread(temp_file.close)
+                    if named:
+                        await asyncio.to_thread(os.unlink, temp_path)
+                except OSError:
                     pass
-            raise RuntimeError(f"Failed to send processed video: {str(e)}")
 
 
 # Global processor instance
@@ -149,7 +440,9 @@ async def process_video_stream(
     message: Message,
     ffmpeg_cmd: list,
     caption: str = "Processed video",
-    progress_callback: Optional[callable] = None
+    progress_callback: Optional[callable] = None,
+    file_name: str = 'video.mp4',
+    as_document: bool = False
 ) -> Message:
     """
     Complete pipeline: stream from telegram -> process with ffmpeg -> send back
@@ -161,4 +454,4 @@ async def process_video_stream(
     output_stream = video_processor.process_with_ffmpeg(input_stream, ffmpeg_cmd, progress_callback)
 
     # Send result back to user
-    return await video_processor.send_processed_video(client, message, output_stream, caption)
\ No newline at end of file
+    return await video_processor.send_processed_video(client, message, output_stream, caption, file_name, as_document)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional, Tuple
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+from .ttl_cache import TTLCache
+
+
+class ChatThrottle:
+    """Spaces out outgoing Telegram requests per chat to stay under the per-chat rate limit"""
+
+    def __init__(self, max_idle_entries: int = 10_000):
+        self._last_sent: Dict[int, float] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self.max_idle_entries = max_idle_entries
+
+    def _prune(self):
+        """Forget chats that have no request in flight"""
+        for chat_id, lock in list(self._locks.items()):
+            if not lock.locked():
+                del self._locks[chat_id]
+                self._last_sent.pop(chat_id, None)
+
+    @asynccontextmanager
+    async def acquire(self, chat_id: int, min_interval: float = 1.0):
+        """
+        Wait for this chat's turn, then hold it for the duration of the block
+
+        Args:
+            chat_id: Telegram chat the request goes to
+            min_interval: Minimum seconds between requests to the same chat
+        """
+        if len(self._locks) > self.max_idle_entries:
+            self._prune()
+
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            wait = self._last_sent.get(chat_id, 0.0) + min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                yield
+            finally:
+                self._last_sent[chat_id] = time.monotonic()
+
+    def ready_at(self, chat_id: int, min_interval: float = 1.0) -> float:
+        """Monotonic time from which acquire() for this chat would not have to wait"""
+        lock = self._locks.get(chat_id)
+        if lock is not None and lock.locked():
+            return time.monotonic() + min_interval  # Request in flight, look again later
+        return self._last_sent.get(chat_id, 0.0) + min_interval
+
+
+class ProgressDispatcher:
+    """
+    Coalesces progress edits from all trackers and sends them at a bounded global rate
+
+    Edits go through the chat throttle, so a chat is never edited more often
+    than min_interval no matter how many of its jobs report progress.
+    """
+
+    def __init__(self, throttle: ChatThrottle, rate: float = 25.0, min_interval: float = 1.0):
+        self.throttle = throttle
+        self.rate = rate  # Edits per second across all chats (bot cap is ~30 msg/s)
+        self.min_interval = min_interval  # Seconds between edits to the same chat
+        # (chat_id, message_id) -> (message, latest text, callback run once that text is shown)
+        self._pending: Dict[Tuple[int, int], Tuple[Message, str, Optional[Callable[[str], None]]]] = {}
+        # Discarded messages, whose final status must not be overwritten by a late progress edit
+        self._closed = TTLCache(maxsize=10_000, ttl=3600)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(message: Message) -> Tuple[int, int]:
+        return message.chat.id, message.id
+
+    def submit(self, message: Message, text: str, on_sent: Optional[Callable[[str], None]] = None):
+        """Queue an edit, replacing any not-yet-sent text for the same message"""
+        key = self._key(message)
+        if key in self._closed:
+            return
+        self._pending[key] = (message, text, on_sent)
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    def discard(self, message: Message):
+        """Drop a queued edit and refuse later ones, e.g. before the final status is written directly"""
+        key = self._key(message)
+        self._closed[key] = True
+        self._pending.pop(key, None)
+
+    async def _run(self):
+        """Send queued edits oldest first, one every 1/rate seconds, skipping chats edited too recently"""
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            ready_at = {key: self.throttle.ready_at(key[0], self.min_interval) for key in self._pending}
+            key = next((key for key, at in ready_at.items() if at <= now), None)
+            if key is None:
+                # Every queued chat is still cooling down; wait for the first, or for a new submit
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(ready_at.values()) - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            message, text, on_sent = self._pending.pop(key)
+            try:
+                async with self.throttle.acquire(key[0], self.min_interval):
+                    await message.edit_text(text)
+            except FloodWait as e:
+                # Back off globally, then retry unless a newer text arrived or the message was discarded meanwhile
+                await asyncio.sleep(e.value)
+                if key not in self._closed:
+                    self._pending.setdefault(key, (message, text, on_sent))
+            except Exception:
+                # Message might have been deleted or edited by user
+                pass
+            else:
+                if on_sent is not None:
+                    on_sent(text)
+
+            await asyncio.sleep(1 / self.rate)
+
+
+# Global throttle shared by all progress trackers
+chat_throttle = ChatThrottle()
+
+# Global dispatcher for periodic progress edits
+progress_dispatcher = ProgressDispatcher(chat_throttle)
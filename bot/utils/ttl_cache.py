@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Hashable, Iterator
+
+
+class TTLCache(MutableMapping):
+    """Dict-like store whose entries expire after a fixed time-to-live"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest first
+
+    def _expire(self):
+        """Drop entries whose time-to-live has passed"""
+        now = time.monotonic()
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+
+    def __getitem__(self, key: Hashable) -> Any:
+        expires_at, value = self._data[key]
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self._expire()
+        self._data.pop(key, None)
+
+        # Evict the oldest entries once the cache is full
+        while len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def __delitem__(self, key: Hashable):
+        del self._data[key]
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator:
+        self._expire()
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        self._expire()
+        return len(self._data)
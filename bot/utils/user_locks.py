@@ -0,0 +1,23 @@
+import asyncio
+import weakref
+
+
+class UserLocks:
+    """
+    Per-user asyncio locks that live exactly as long as someone uses them
+
+    Locks are held weakly: a lock stays in the map while a handler holds it or
+    waits on it (their frames keep it alive) and drops out once nobody does, so
+    two handlers never end up with different locks for one user and idle users
+    cost nothing, however their state was removed (cleared or expired).
+    """
+
+    def __init__(self):
+        self._locks: 'weakref.WeakValueDictionary[int, asyncio.Lock]' = weakref.WeakValueDictionary()
+
+    def __call__(self, user_id: int) -> asyncio.Lock:
+        """Get the state lock for a user"""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock